@@ -0,0 +1,129 @@
+import json
+import math
+import time
+import threading
+
+from statistics import NormalDist
+
+from utils import atomic_write
+
+GROUP_FIELDS = ("category", "question_type")
+
+
+def wilson_interval(correct, total, confidence=0.95):
+    if total == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    p = correct / total
+    denominator = 1 + z * z / total
+    center = (p + z * z / (2 * total)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+class ScoreAggregator:
+    # running correct/total counts per category, question type, parser and
+    # document; adding a document again replaces its earlier scores
+    def __init__(self, parser=None, confidence=0.95):
+        self.parser = parser
+        self.confidence = confidence
+        self.counts = {}
+        self.documents = {}
+        self._lock = threading.Lock()
+
+    def _update(self, keys, scores, sign):
+        for key, score in zip(keys, scores):
+            counts = self.counts.setdefault(key, [0, 0])
+            counts[0] += sign * score
+            counts[1] += sign
+
+    def _keys(self, document, questions):
+        keys = []
+        for question in questions:
+            question_keys = [("all", "all"), ("document", document)]
+            if self.parser is not None:
+                question_keys.append(("parser", self.parser))
+            for field in GROUP_FIELDS:
+                question_keys.append((field, question.get(field) or "unknown"))
+            keys.append(question_keys)
+        return keys
+
+    def add(self, document, questions, scores):
+        scores = [1 if score else 0 for score in scores]
+        keys = self._keys(document, questions)
+        with self._lock:
+            previous = self.documents.pop(document, None)
+            if previous is not None:
+                for question_keys, score in zip(*previous):
+                    self._update(question_keys, [score] * len(question_keys), -1)
+            for question_keys, score in zip(keys, scores):
+                self._update(question_keys, [score] * len(question_keys), 1)
+            self.documents[document] = (keys, scores)
+
+    def group(self, key):
+        correct, total = self.counts.get(key, (0, 0))
+        low, high = wilson_interval(correct, total, self.confidence)
+        return {
+            "correct": correct,
+            "total": total,
+            "mean": correct / total if total else 0.0,
+            "ci_low": low,
+            "ci_high": high,
+        }
+
+    def overall(self):
+        with self._lock:
+            return self.group(("all", "all"))
+
+    def converged(self, max_ci_width, min_questions=0):
+        overall = self.overall()
+        if overall["total"] < max(min_questions, 1):
+            return False
+        return overall["ci_high"] - overall["ci_low"] <= max_ci_width
+
+    def summary(self):
+        with self._lock:
+            summary = {"confidence": self.confidence, "documents": len(self.documents)}
+            for field, value in sorted(self.counts, key=lambda key: (key[0], str(key[1]))):
+                if field == "all":
+                    summary["all"] = self.group((field, value))
+                else:
+                    summary.setdefault(field, {})[value] = self.group((field, value))
+            return summary
+
+
+def format_breakdown(summary, fields=("parser",) + GROUP_FIELDS):
+    lines = []
+    rows = [("all", summary.get("all"))]
+    for field in fields:
+        for value, group in summary.get(field, {}).items():
+            rows.append(("{}: {}".format(field, value), group))
+
+    for label, group in rows:
+        if group is None:
+            continue
+        lines.append("{:<50} {:.4f} [{:.4f}, {:.4f}] n={}".format(
+            label, group["mean"], group["ci_low"], group["ci_high"], group["total"]
+        ))
+    return "\n".join(lines)
+
+
+class BreakdownWriter:
+    # writes score_breakdown.json/.txt at most every interval seconds while
+    # documents complete, and once more at the end
+    def __init__(self, aggregator, json_path, text_path, interval=5.0):
+        self.aggregator = aggregator
+        self.json_path = json_path
+        self.text_path = text_path
+        self.interval = interval
+        self.written = 0.0
+        self._lock = threading.Lock()
+
+    def write(self, force=False):
+        with self._lock:
+            if not force and time.monotonic() - self.written < self.interval:
+                return
+            self.written = time.monotonic()
+            summary = self.aggregator.summary()
+            atomic_write(self.json_path, json.dumps(summary, indent=2))
+            atomic_write(self.text_path, format_breakdown(summary) + "\n")
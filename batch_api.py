@@ -0,0 +1,103 @@
+import json
+import time
+
+import openai
+
+# limits of a single OpenAI batch job
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 190 * 1024 * 1024
+
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def write_batch_file(requests, endpoint="/v1/chat/completions"):
+    # requests is a list of (custom_id, body); returns one or more JSONL
+    # payloads that each fit in a single batch job
+    payloads = []
+    lines = []
+    size = 0
+    for custom_id, body in requests:
+        line = json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": endpoint,
+            "body": body,
+        }, ensure_ascii=False).encode("utf-8") + b"\n"
+
+        if lines and (len(lines) >= MAX_BATCH_REQUESTS or size + len(line) > MAX_BATCH_BYTES):
+            payloads.append(b"".join(lines))
+            lines = []
+            size = 0
+        lines.append(line)
+        size += len(line)
+
+    if lines:
+        payloads.append(b"".join(lines))
+    return payloads
+
+
+def submit_batch(payload, endpoint="/v1/chat/completions", completion_window="24h"):
+    input_file = openai.files.create(file=("batch.jsonl", payload), purpose="batch")
+    batch = openai.batches.create(
+        input_file_id=input_file.id,
+        endpoint=endpoint,
+        completion_window=completion_window,
+    )
+    return batch.id
+
+
+def wait_for_batch(batch_id, poll_interval=30, timeout=None):
+    start_time = time.time()
+    while True:
+        batch = openai.batches.retrieve(batch_id)
+        if batch.status in TERMINAL_STATUSES:
+            return batch
+
+        if timeout is not None and time.time() - start_time > timeout:
+            openai.batches.cancel(batch_id)
+            raise TimeoutError("Batch {} did not finish in {} seconds".format(batch_id, timeout))
+
+        counts = batch.request_counts
+        if counts is not None:
+            print("Batch {} {}: {}/{} requests done".format(
+                batch_id, batch.status, counts.completed + counts.failed, counts.total
+            ))
+        time.sleep(poll_interval)
+
+
+def read_batch_results(batch):
+    # custom_id -> message content, or None for requests that failed
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+
+        content = openai.files.content(file_id).text
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") == 200:
+                body = response["body"]
+                results[record["custom_id"]] = body["choices"][0]["message"]["content"]
+            else:
+                results.setdefault(record["custom_id"], None)
+
+    return results
+
+
+def run_batch(requests, endpoint="/v1/chat/completions", poll_interval=30, timeout=None):
+    batch_ids = [submit_batch(payload, endpoint) for payload in write_batch_file(requests, endpoint)]
+    print("Submitted {} requests in {} batch jobs".format(len(requests), len(batch_ids)))
+
+    results = {}
+    for batch_id in batch_ids:
+        batch = wait_for_batch(batch_id, poll_interval=poll_interval, timeout=timeout)
+        if batch.status != "completed":
+            print("Batch {} ended with status {}".format(batch_id, batch.status))
+        results.update(read_batch_results(batch))
+
+    for custom_id, _ in requests:
+        results.setdefault(custom_id, None)
+    return results
@@ -0,0 +1,263 @@
+import time
+import random
+import argparse
+
+from textract import post_process
+
+
+# Copy of the original per-cell linear scan, kept to measure the speedup.
+def legacy_post_process(data):
+    def get_text(result, blocks_map):
+        text = ""
+        if "Relationships" in result:
+            for relationship in result["Relationships"]:
+                if relationship["Type"] == "CHILD":
+                    for child_id in relationship["Ids"]:
+                        word = blocks_map[child_id]
+                        if word["BlockType"] == "WORD":
+                            text += " " + word["Text"]
+        return text[1:]
+
+    all_elems = {}
+    for elem in data["Blocks"]:
+        _id = elem["Id"]
+        all_elems[_id] = elem
+
+    processed_list = []
+    for idx, elem in enumerate(data["Blocks"]):
+        if elem["BlockType"] == "LAYOUT_LIST":
+            continue
+
+        if "LAYOUT" in elem["BlockType"] and elem["BlockType"] != "LAYOUT_TABLE":
+
+            bbox = elem["Geometry"]["BoundingBox"]
+
+            x = bbox["Left"]
+            y = bbox["Top"]
+            w = bbox["Width"]
+            h = bbox["Height"]
+
+            coord = [
+                [x, y],
+                [x + w, y],
+                [x + w, y + h],
+                [x, y + h]
+            ]
+            xy_coord = [{"x": x, "y": y} for x, y in coord]
+
+            # category = CATEGORY_MAP.get(elem["BlockType"], "paragraph")
+            category = elem["BlockType"]
+
+            transcription = ""
+
+            if elem["BlockType"] != "LAYOUT_FIGURE":
+                for item in all_elems[elem["Id"]]["Relationships"]:
+                    for id_ in item["Ids"]:
+                        if all_elems[id_]["BlockType"] == "LINE":
+                            word = all_elems[id_]["Text"]
+                            transcription += word + "\n"
+
+            data_dict = {
+                "coordinates": xy_coord,
+                "category": category,
+                "id": idx,
+                "content": {
+                    "text": transcription,
+                    "html": "",
+                    "markdown": ""
+                }
+            }
+            processed_list.append(data_dict)
+
+        elif elem["BlockType"] == "TABLE":
+
+            bbox = elem["Geometry"]["BoundingBox"]
+
+            x = bbox["Left"]
+            y = bbox["Top"]
+            w = bbox["Width"]
+            h = bbox["Height"]
+
+            coord = [
+                [x, y],
+                [x + w, y],
+                [x + w, y + h],
+                [x, y + h]
+            ]
+            xy_coord = [{"x": x, "y": y} for x, y in coord]
+
+            # category = CATEGORY_MAP.get(elem["BlockType"], "paragraph")
+            category = elem["BlockType"]
+
+            table_cells = {}
+            for relationship in elem["Relationships"]:
+                if relationship["Type"] == "CHILD":
+                    for cell_id in relationship["Ids"]:
+                        cell_block = next((block for block in data["Blocks"] if block["Id"] == cell_id), None)
+                        if cell_block is not None and cell_block["BlockType"] == "CELL":
+                            row_index = cell_block["RowIndex"] - 1
+                            column_index = cell_block["ColumnIndex"] - 1
+                            row_span = cell_block["RowSpan"]
+                            column_span = cell_block["ColumnSpan"]
+                            table_cells[(row_index, column_index)] = {
+                                "block": cell_block,
+                                "span": (row_span, column_span),
+                                "text": get_text(cell_block, all_elems),
+                            }
+            max_row_index = max(cell[0] for cell in table_cells.keys())
+            max_column_index = max(cell[1] for cell in table_cells.keys())
+            for relationship in elem["Relationships"]:
+                if relationship["Type"] == "MERGED_CELL":
+                    for cell_id in relationship["Ids"]:
+                        cell_block = next((block for block in data["Blocks"] if block["Id"] == cell_id), None)
+                        if cell_block is not None and cell_block["BlockType"] == "MERGED_CELL":
+                            row_index = cell_block["RowIndex"] - 1
+                            column_index = cell_block["ColumnIndex"] - 1
+                            row_span = cell_block["RowSpan"]
+                            column_span = cell_block["ColumnSpan"]
+                            for i in range(row_span):
+                                for j in range(column_span):
+                                    del table_cells[(row_index + i, column_index + j)]
+                            text = ""
+                            for child_ids in cell_block["Relationships"][0]["Ids"]:
+                                child_cell_block = next((block for block in data["Blocks"] if block["Id"] == child_ids), None)
+                                text += " " + get_text(child_cell_block, all_elems)
+                            table_cells[(row_index, column_index)] = {
+                                "block": cell_block,
+                                "span": (row_span, column_span),
+                                "text": text[1:],
+                            }
+            html_table = "<table>"
+
+            for row_index in range(max_row_index + 1):
+                html_table += "<tr>"
+                for column_index in range(max_column_index + 1):
+                    cell_data = table_cells.get((row_index, column_index))
+                    if cell_data:
+                        cell_block = cell_data["block"]
+                        row_span, column_span = cell_data["span"]
+
+                        cell_text = cell_data["text"]
+                        html_table += f"<td rowspan='{row_span}' colspan='{column_span}''>{cell_text}</td>"
+                html_table += "</tr>"
+            html_table += "</table>"
+
+            data_dict = {
+                "coordinates": xy_coord,
+                "category": category,
+                "id": idx,
+                "content": {
+                    "text": "",
+                    "html": html_table,
+                    "markdown": ""
+                }
+            }
+            processed_list.append(data_dict)
+
+    return processed_list
+
+
+def synthetic_page(n_tables=4, n_rows=60, n_columns=12, words_per_cell=3, merged_every=7, seed=0):
+    rng = random.Random(seed)
+    blocks = []
+    counter = iter(range(10 ** 9))
+
+    def new_id():
+        return "b{}".format(next(counter))
+
+    def geometry():
+        return {"BoundingBox": {"Left": rng.random(), "Top": rng.random(), "Width": 0.1, "Height": 0.05}}
+
+    def words(n):
+        ids = []
+        for _ in range(n):
+            word = {"Id": new_id(), "BlockType": "WORD", "Text": "{:,}".format(rng.randint(0, 10 ** 6))}
+            blocks.append(word)
+            ids.append(word["Id"])
+        return ids
+
+    for _ in range(n_tables):
+        line_ids = []
+        for _ in range(3):
+            line = {"Id": new_id(), "BlockType": "LINE", "Text": "Table heading", "Relationships": [
+                {"Type": "CHILD", "Ids": words(2)}
+            ]}
+            blocks.append(line)
+            line_ids.append(line["Id"])
+        blocks.append({
+            "Id": new_id(), "BlockType": "LAYOUT_TITLE", "Geometry": geometry(),
+            "Relationships": [{"Type": "CHILD", "Ids": line_ids}],
+        })
+
+        cells = {}
+        for row in range(1, n_rows + 1):
+            for column in range(1, n_columns + 1):
+                cell = {
+                    "Id": new_id(), "BlockType": "CELL",
+                    "RowIndex": row, "ColumnIndex": column, "RowSpan": 1, "ColumnSpan": 1,
+                    "Relationships": [{"Type": "CHILD", "Ids": words(words_per_cell)}],
+                }
+                blocks.append(cell)
+                cells[(row, column)] = cell["Id"]
+
+        merged_ids = []
+        for row in range(1, n_rows, merged_every):
+            merged = {
+                "Id": new_id(), "BlockType": "MERGED_CELL",
+                "RowIndex": row, "ColumnIndex": 1, "RowSpan": 1, "ColumnSpan": 2,
+                "Relationships": [{"Type": "CHILD", "Ids": [cells[(row, 1)], cells[(row, 2)]]}],
+            }
+            blocks.append(merged)
+            merged_ids.append(merged["Id"])
+
+        blocks.append({
+            "Id": new_id(), "BlockType": "TABLE", "Geometry": geometry(),
+            "Relationships": [
+                {"Type": "CHILD", "Ids": list(cells.values())},
+                {"Type": "MERGED_CELL", "Ids": merged_ids},
+            ],
+        })
+
+    rng.shuffle(blocks)
+    return {"Blocks": blocks}
+
+
+def timeit(fn, data, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = fn(data)
+        best = min(best, time.perf_counter() - start_time)
+    return best, result
+
+
+def normalize(processed_list):
+    # the original emitted a stray quote after colspan
+    for elem in processed_list:
+        elem["content"]["html"] = elem["content"]["html"].replace("''>", "'>")
+    return processed_list
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--tables", type=int, default=4)
+    argparser.add_argument("--rows", type=int, nargs="+", default=[10, 30, 60])
+    argparser.add_argument("--columns", type=int, default=12)
+    argparser.add_argument("--repeat", type=int, default=3)
+    argparser.add_argument("--skip_legacy", action="store_true")
+    args = argparser.parse_args()
+
+    print("{:>6} {:>8} {:>12} {:>12} {:>9}".format("rows", "blocks", "legacy (s)", "indexed (s)", "speedup"))
+    for n_rows in args.rows:
+        data = synthetic_page(n_tables=args.tables, n_rows=n_rows, n_columns=args.columns)
+        new_time, new_result = timeit(post_process, data, args.repeat)
+
+        if args.skip_legacy:
+            print("{:>6} {:>8} {:>12} {:>12.4f} {:>9}".format(n_rows, len(data["Blocks"]), "-", new_time, "-"))
+            continue
+
+        legacy_time, legacy_result = timeit(legacy_post_process, data, args.repeat)
+        assert normalize(legacy_result) == new_result, "outputs differ"
+        print("{:>6} {:>8} {:>12.4f} {:>12.4f} {:>8.1f}x".format(
+            n_rows, len(data["Blocks"]), legacy_time, new_time, legacy_time / new_time
+        ))
@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import contextlib
+
+from cache import make_key
+from engine import run
+
+
+class WorkQueue:
+    # shards of a job in a SQLite file; workers on this machine, or on other
+    # hosts sharing the file, claim one shard at a time. A shard whose worker
+    # stops sending heartbeats is handed to another worker after lease seconds
+    def __init__(self, path, lease=600, max_attempts=3):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        with self.transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job TEXT PRIMARY KEY, command TEXT NOT NULL, shards INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "job TEXT NOT NULL, shard INTEGER NOT NULL, status TEXT NOT NULL, "
+                "worker TEXT, attempts INTEGER NOT NULL DEFAULT 0, heartbeat REAL, returncode INTEGER, "
+                "dead_letters INTEGER, PRIMARY KEY (job, shard))"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(tasks)")]
+            if "dead_letters" not in columns:
+                # queues created before dead letters were reported
+                conn.execute("ALTER TABLE tasks ADD COLUMN dead_letters INTEGER")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # a connection per transaction, so the queue can be shared by threads
+        # and processes; BEGIN IMMEDIATE serializes claims
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def submit(self, command, shards, requeue=False):
+        # submitting the same command again resumes it: finished shards are
+        # kept unless requeue is set, failed ones are tried again
+        job = make_key("job", command, shards)[:16]
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO jobs (job, command, shards) VALUES (?, ?, ?)",
+                (job, json.dumps(command), shards)
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (job, shard, status) VALUES (?, ?, 'pending')",
+                [(job, shard) for shard in range(shards)]
+            )
+            statuses = ("failed", "done") if requeue else ("failed",)
+            conn.execute(
+                "UPDATE tasks SET status = 'pending', attempts = 0 WHERE job = ? AND status IN ({})".format(
+                    ", ".join("?" * len(statuses))
+                ),
+                (job,) + statuses
+            )
+        return job
+
+    def claim(self, worker, job=None):
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT tasks.job, tasks.shard, jobs.shards, jobs.command FROM tasks "
+                "JOIN jobs ON jobs.job = tasks.job "
+                "WHERE (tasks.status = 'pending' OR (tasks.status = 'running' AND tasks.heartbeat < ?)) "
+                "AND (? IS NULL OR tasks.job = ?) "
+                "ORDER BY tasks.attempts, tasks.job, tasks.shard LIMIT 1",
+                (now - self.lease, job, job)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE tasks SET status = 'running', worker = ?, attempts = attempts + 1, heartbeat = ? "
+                "WHERE job = ? AND shard = ?",
+                (worker, now, row[0], row[1])
+            )
+        return {"job": row[0], "shard": row[1], "shards": row[2], "command": json.loads(row[3])}
+
+    def heartbeat(self, task, worker):
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET heartbeat = ? WHERE job = ? AND shard = ? AND worker = ?",
+                (time.time(), task["job"], task["shard"], worker)
+            )
+
+    def finish(self, task, worker, returncode, dead_letters=None):
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = CASE "
+                "WHEN ? = 0 THEN 'done' WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "returncode = ?, dead_letters = ? WHERE job = ? AND shard = ? AND worker = ?",
+                (returncode, self.max_attempts, returncode, dead_letters, task["job"], task["shard"], worker)
+            )
+
+    def status(self, job):
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT status, COUNT(*) FROM tasks WHERE job = ? GROUP BY status", (job,)
+            ).fetchall()
+        return dict(rows)
+
+    def dead_letters(self, job):
+        # shard -> items its last run dead-lettered, for shards that had any
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT shard, dead_letters FROM tasks WHERE job = ? AND dead_letters > 0 ORDER BY shard", (job,)
+            ).fetchall()
+        return dict(rows)
+
+    def failed_shards(self, job):
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT shard FROM tasks WHERE job = ? AND status = 'failed' ORDER BY shard", (job,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+
+def shard_command(command, shard, shards):
+    return [sys.executable] + command + ["--shard", "{}/{}".format(shard, shards)]
+
+
+def report(**fields):
+    # called by the entry points at the end of a shard run; the worker that
+    # started the shard reads these fields back from WORK_QUEUE_REPORT
+    path = os.environ.get("WORK_QUEUE_REPORT")
+    if path:
+        with open(path, "w") as f:
+            json.dump(fields, f)
+
+
+def read_report(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def run_worker(queue, worker, job=None, heartbeat_interval=30):
+    # runs shards one after another as child processes until none is left
+    # to claim; returns the number of shards run
+    count = 0
+    while True:
+        task = queue.claim(worker, job)
+        if task is None:
+            return count
+        print("{}: shard {}/{} of job {}".format(worker, task["shard"], task["shards"], task["job"]))
+        report_path = os.path.join(
+            tempfile.gettempdir(), "work-queue-{}-{}-{}.json".format(task["job"], task["shard"], os.getpid())
+        )
+        process = subprocess.Popen(
+            shard_command(task["command"], task["shard"], task["shards"]),
+            env={**os.environ, "WORK_QUEUE_REPORT": report_path}
+        )
+        last_heartbeat = time.monotonic()
+        while process.poll() is None:
+            time.sleep(1)
+            if time.monotonic() - last_heartbeat >= heartbeat_interval:
+                queue.heartbeat(task, worker)
+                last_heartbeat = time.monotonic()
+        queue.finish(task, worker, process.returncode, read_report(report_path).get("dead_letters"))
+        count += 1
+
+
+def worker_name(index):
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), index)
+
+
+def wait_for_job(queue, job, poll_interval=10):
+    # shards still running on other hosts, or waiting for a retry
+    while True:
+        status = queue.status(job)
+        if not status.get("pending") and not status.get("running"):
+            return status
+        run_worker(queue, worker_name("wait"), job)
+        time.sleep(poll_interval)
+
+
+def coordinate(command, shards, workers, queue, requeue=False):
+    job = queue.submit(command, shards, requeue=requeue)
+    print("job {}: {} shards, {} local workers, queue {}".format(job, shards, workers, queue.path))
+    run(
+        list(range(workers)),
+        lambda index: run_worker(queue, worker_name(index), job),
+        concurrency=workers, desc="Workers"
+    )
+    status = wait_for_job(queue, job)
+
+    failed = queue.failed_shards(job)
+    if failed:
+        print("Failed shards: {} (run the same command again to retry them)".format(failed))
+    dead_letters = queue.dead_letters(job)
+    if dead_letters:
+        # such shards are "done", but some of their items were not processed
+        status["dead_letters"] = sum(dead_letters.values())
+        print("Dead-lettered items: {} in shards {} (replay them with --replay_dead_letters --shard i/N)".format(
+            status["dead_letters"], sorted(dead_letters)
+        ))
+    # the entry point merges whatever the shards produced
+    subprocess.run([sys.executable] + command + ["--merge_shards", str(shards)], check=True)
+    return status
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Run extract_contents.py or run_qa_eval.py as N shards over a SQLite work queue."
+    )
+    subparsers = argparser.add_subparsers(dest="mode", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Submit a job, work on it and merge the results.")
+    run_parser.add_argument("--shards", type=int, required=True)
+    run_parser.add_argument("--workers", type=int, default=os.cpu_count())
+    run_parser.add_argument("--queue", type=str, default=".cache/work_queue.sqlite")
+    run_parser.add_argument("--lease", type=float, default=600)
+    run_parser.add_argument("--max_attempts", type=int, default=3)
+    run_parser.add_argument("--requeue", action="store_true")
+    run_parser.add_argument("command", nargs=argparse.REMAINDER)
+
+    worker_parser = subparsers.add_parser("worker", help="Work on the shards of every job in a queue.")
+    worker_parser.add_argument("--workers", type=int, default=os.cpu_count())
+    worker_parser.add_argument("--queue", type=str, default=".cache/work_queue.sqlite")
+    worker_parser.add_argument("--lease", type=float, default=600)
+    worker_parser.add_argument("--max_attempts", type=int, default=3)
+    args = argparser.parse_args()
+
+    queue = WorkQueue(args.queue, lease=args.lease, max_attempts=args.max_attempts)
+    if args.mode == "run":
+        command = args.command[1:] if args.command[:1] == ["--"] else args.command
+        if not command:
+            argparser.error("give the script and its arguments after --")
+        status = coordinate(command, args.shards, args.workers, queue, requeue=args.requeue)
+        print("Shards: {}".format(", ".join("{} {}".format(count, name) for name, count in sorted(status.items()))))
+    else:
+        counts = run(
+            list(range(args.workers)),
+            lambda index: run_worker(queue, worker_name(index)),
+            concurrency=args.workers, desc="Workers"
+        )
+        print("Ran {} shards".format(sum(counts)))
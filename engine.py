@@ -0,0 +1,261 @@
+import time
+import asyncio
+import functools
+import threading
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+import timing
+from resilience import call_observer, is_retryable
+
+
+class RateLimiter:
+    def __init__(self, requests_per_second=None, tokens_per_minute=None):
+        self.requests_per_second = requests_per_second
+        self.tokens_per_minute = tokens_per_minute
+
+        # token buckets: capacity allows a burst of one second of requests
+        # and one minute of tokens
+        self._request_capacity = max(1.0, requests_per_second or 0)
+        self._token_capacity = tokens_per_minute or 0
+        self._requests = self._request_capacity
+        self._tokens = self._token_capacity
+        self._updated = time.monotonic()
+        self._lock = None
+        self._loop = None
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_second:
+            self._requests = min(
+                self._request_capacity,
+                self._requests + elapsed * self.requests_per_second
+            )
+        if self.tokens_per_minute:
+            self._tokens = min(
+                self._token_capacity,
+                self._tokens + elapsed * self.tokens_per_minute / 60
+            )
+
+    def _wait_time(self, tokens):
+        wait = 0.0
+        if self.requests_per_second and self._requests < 1:
+            wait = (1 - self._requests) / self.requests_per_second
+        if self.tokens_per_minute and tokens:
+            # a request larger than the bucket only waits for a full bucket
+            needed = min(tokens, self._token_capacity)
+            if self._tokens < needed:
+                wait = max(wait, (needed - self._tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    async def acquire(self, tokens=0):
+        # the same limiter is reused across run() calls, each with its own loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            if self.requests_per_second:
+                self._requests -= 1
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+
+
+class AdaptiveConcurrency:
+    # AIMD limit on in-flight requests: grows by one slot per limit's worth of
+    # calls while latency stays near its long-term average, and is cut by
+    # decrease on a throttled / retryable error or a latency spike, at most
+    # once per average latency so one burst of failures counts once
+    def __init__(self, initial=8, minimum=1, maximum=64, decrease=0.5, latency_tolerance=2.0):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.short_latency = None
+        self.long_latency = None
+        self.backoffs = 0
+        self._decreased = 0.0
+        self._lock = threading.Lock()
+        self._condition = None
+        self._loop = None
+
+    @property
+    def current(self):
+        return int(self.limit)
+
+    def observe(self, latency, exc=None):
+        with self._lock:
+            if exc is not None:
+                if is_retryable(exc):
+                    self._back_off()
+                return
+            if self.short_latency is None:
+                self.short_latency = self.long_latency = latency
+            self.short_latency += 0.3 * (latency - self.short_latency)
+            self.long_latency += 0.05 * (latency - self.long_latency)
+            if self.short_latency > self.latency_tolerance * self.long_latency:
+                self._back_off()
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def _back_off(self):
+        now = time.monotonic()
+        if now - self._decreased < (self.long_latency or 0.0):
+            return
+        self._decreased = now
+        self.backoffs += 1
+        self.limit = max(self.minimum, self.limit * self.decrease)
+
+    async def __aenter__(self):
+        # the same limit is reused across run() calls, each with its own loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.current)
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def __str__(self):
+        return "limit={} in_flight={} backoffs={}".format(self.current, self.in_flight, self.backoffs)
+
+
+def slots(concurrency):
+    # (worker threads, async context limiting in-flight calls)
+    if isinstance(concurrency, AdaptiveConcurrency):
+        return concurrency.maximum, concurrency
+    return concurrency, asyncio.Semaphore(concurrency)
+
+
+async def call_worker(worker, item, executor=None):
+    if asyncio.iscoroutinefunction(worker):
+        return await worker(item)
+
+    # copy the context so context variables set by the caller reach the thread
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        executor, functools.partial(context.run, worker, item)
+    )
+
+
+async def run_tasks(items, worker, concurrency=8, rate_limiter=None, cost=None, desc=None):
+    # concurrency is a fixed number of in-flight calls or an AdaptiveConcurrency
+    items = list(items)
+    results = [None] * len(items)
+    max_workers, semaphore = slots(concurrency)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    progress = tqdm(total=len(items), desc=desc)
+    adaptive = semaphore if isinstance(semaphore, AdaptiveConcurrency) else None
+    # worker threads inherit the observer through the copied context, so
+    # call_with_retry reports every provider call to the adaptive limit
+    call_observer.set(adaptive.observe if adaptive is not None else None)
+
+    async def run_one(idx, item):
+        queued = time.perf_counter()
+        async with semaphore:
+            if rate_limiter is not None:
+                await rate_limiter.acquire(cost(item) if cost else 0)
+            with timing.labels(queue_wait=time.perf_counter() - queued):
+                results[idx] = await call_worker(worker, item, executor)
+        if adaptive is not None:
+            progress.set_postfix_str(str(adaptive), refresh=False)
+        progress.update(1)
+
+    try:
+        await asyncio.gather(*(run_one(idx, item) for idx, item in enumerate(items)))
+    finally:
+        progress.close()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return results
+
+
+def run(items, worker, **kwargs):
+    return asyncio.run(run_tasks(items, worker, **kwargs))
+
+
+async def run_pipeline(items, stages, queue_size=16, desc=None):
+    # stages is a list of (worker, concurrency); each stage feeds the next
+    # through a bounded queue so downstream work overlaps with upstream work.
+    # A stage with an AdaptiveConcurrency runs up to its maximum workers,
+    # of which only the current limit call the provider at once
+    items = list(items)
+    results = [None] * len(items)
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+    limits = [slots(concurrency) for _, concurrency in stages]
+    executors = [ThreadPoolExecutor(max_workers=max_workers) for max_workers, _ in limits]
+    adaptive = [limit for _, limit in limits if isinstance(limit, AdaptiveConcurrency)]
+    progress = tqdm(total=len(items), desc=desc)
+
+    async def feed():
+        for idx, item in enumerate(items):
+            await queues[0].put((idx, item, time.perf_counter()))
+
+    async def stage_worker(stage_idx):
+        worker, _ = stages[stage_idx]
+        limit = limits[stage_idx][1]
+        if isinstance(limit, AdaptiveConcurrency):
+            call_observer.set(limit.observe)
+        while True:
+            entry = await queues[stage_idx].get()
+            if entry is None:
+                break
+            idx, item, queued = entry
+            async with limit:
+                with timing.labels(queue_wait=time.perf_counter() - queued):
+                    result = await call_worker(worker, item, executors[stage_idx])
+            if stage_idx + 1 < len(stages):
+                await queues[stage_idx + 1].put((idx, result, time.perf_counter()))
+            else:
+                results[idx] = result
+                if adaptive:
+                    progress.set_postfix_str(" | ".join(str(limit) for limit in adaptive), refresh=False)
+                progress.update(1)
+
+    async def run_stage(stage_idx, upstream):
+        await upstream
+        for _ in range(limits[stage_idx][0]):
+            await queues[stage_idx].put(None)
+
+    workers = []
+    upstream = asyncio.ensure_future(feed())
+    for stage_idx, (max_workers, _) in enumerate(limits):
+        workers += [asyncio.ensure_future(stage_worker(stage_idx)) for _ in range(max_workers)]
+        stage_workers = asyncio.gather(*workers[-max_workers:])
+        # the stop signal for this stage is sent once its producer is done
+        workers.append(asyncio.ensure_future(run_stage(stage_idx, upstream)))
+        upstream = stage_workers
+
+    try:
+        await asyncio.gather(upstream, *workers)
+    finally:
+        progress.close()
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return results
+
+
+def run_stages(items, stages, **kwargs):
+    return asyncio.run(run_pipeline(items, stages, **kwargs))
@@ -1,451 +1,154 @@
 import os
 import time
-import boto3
-import pyhtml2md
+import asyncio
 import argparse
-import requests
-import nest_asyncio
-import unstructured_client
 
-from tqdm import tqdm
+import timing
+import distributed
+from cache import make_key, open_cache, print_stats
+from engine import AdaptiveConcurrency, RateLimiter, run_tasks, slots
+from fixtures import open_recorder, timed_call
+from manifest import open_manifest
+from preprocess import PreprocessOptions, preprocess_images
+from providers import PROVIDERS, get_provider
+from resilience import CircuitBreaker, RetryPolicy, call_with_retry, open_dead_letters
+from result_store import ResultStore, merge_stores
+from tables import normalize_tables
+from utils import atomic_write, get_image_path_list, parse_shard, save_txt, shard_dir, shard_path
+
+
+def run_extraction(
+    image_dir, save_dir, provider,
+    concurrency=8, rate_limiter=None, cache=None, manifest=None,
+    policy=None, breaker=None, dead_letters=None, image_path_list=None,
+    timing_log=None, timing_parquet=False, store=None,
+    preprocess_options=None, preprocess_processes=None, recorder=None,
+    normalize=True
+):
+    # with preprocessing, the provider gets a downscaled / recompressed copy
+    # of each image, and duplicates reuse the content of the first copy
+    prepared = {}
+    duplicates = {}
+
+    def parse(image_path, input_hash):
+        timing.set_status("ok")
+        with timing.phase("provider"):
+            content, latency = call_with_retry(
+                timed_call(provider.parse), prepared.get(image_path, image_path), policy=policy, breaker=breaker
+            )
+        if recorder is not None:
+            recorder.add("extract", input_hash, content, latency, provider=provider.name)
+        return content
+
+    def process(image_path, content=None):
+        item = os.path.relpath(image_path, image_dir)
+        with timing.timed(timing_log, kind="extract", provider=provider.name, item=item):
+            return process_item(image_path, item, content)
+
+    def process_item(image_path, item, content=None):
+        with timing.phase("read"):
+            with open(prepared.get(image_path, image_path), "rb") as f:
+                input_hash = make_key("extract", provider.name, provider.options, f.read())
+
+        if manifest is not None and manifest.is_done(item, input_hash):
+            timing.set_status("skipped")
+            return None
+
+        if content is not None:
+            timing.set_status("duplicate")
+            save_content(image_path, item, input_hash, content)
+            return content
 
-from llama_parse import LlamaParse
-from llama_index.core import Settings
-from llama_index.core.schema import ImageDocument, TextNode
-from llama_index.llms.anthropic import Anthropic
-from llama_index.multi_modal_llms.anthropic import AnthropicMultiModal
-
-from unstructured_client.models import operations, shared
-
-from utils import get_image_path_list, save_txt
-
-LLAMAPARSE_API_KEY = ""
-OPENAI_API_KEY = ""
-UPSTAGE_API_KEY = ""
-UNSTRUCTURED_API_KEY = ""
-
-AWS_ACCESS_KEY_ID = ""
-AWS_SECRET_ACCESS_KEY = ""
-AWS_REGION = ""
-
-
-def infer_llamaparse(image_dir, save_dir):
-    parser = LlamaParse(
-        api_key=LLAMAPARSE_API_KEY,
-        result_type="markdown",
-        premium_mode=True  # "markdown" and "text" are available
-    )
-    start_time = time.time()
-    image_path_list = get_image_path_list(image_dir)
-    for image_path in tqdm(image_path_list):
-        try:
-            documents = parser.load_data(str(image_path))[0].text
-            save_txt(image_path, image_dir, save_dir, documents)
-        except IndexError:
-            print("Error processing file {}...".format(image_path))
-            pass
-    total_time = time.time() - start_time
-    print("time: ", total_time)
-    print("avg time:: ", total_time / len(image_path_list))
-
-    txt_save_path = os.path.join(save_dir, "time.txt")
-    with open(txt_save_path, "w") as f:
-        f.write("time: {}\n".format(total_time))
-        f.write("avg time: {}\n".format(total_time / len(image_path_list)))
-
-
-def infer_sonnet(image_dir, save_dir):
-    parser = LlamaParse(
-        api_key=LLAMAPARSE_API_KEY,
-        result_type="markdown",  # "markdown" and "text" are available
-        use_vendor_multimodal_model=True,
-        vendor_multimodal_model_name="anthropic-sonnet-3.5",
-    )
-
-    start_time = time.time()
-    image_path_list = get_image_path_list(image_dir)
-    for image_path in tqdm(image_path_list):
-        try:
-            documents = parser.load_data(str(image_path))[0].text
-            save_txt(image_path, image_dir, save_dir, documents)
-        except IndexError:
-            pass
-    total_time = time.time() - start_time
-    print("time: ", total_time)
-    print("avg time:: ", total_time / len(image_path_list))
-
-    txt_save_path = os.path.join(save_dir, "time.txt")
-    with open(txt_save_path, "w") as f:
-        f.write("time: {}\n".format(total_time))
-        f.write("avg time: {}\n".format(total_time / len(image_path_list)))
-
-
-def infer_gpt4o(image_dir, save_dir):
-    parser = LlamaParse(
-        api_key=LLAMAPARSE_API_KEY,
-        result_type="markdown",  # "markdown" and "text" are available
-        use_vendor_multimodal_model=True,
-        vendor_multimodal_model="openai-gpt4o",
-        gpt4o_api_key=OPENAI_API_KEY,
-    )
-
-    start_time = time.time()
-    image_path_list = get_image_path_list(image_dir)
-    for image_path in tqdm(image_path_list):
         try:
-            documents = parser.load_data(str(image_path))[0].text
-            save_txt(image_path, image_dir, save_dir, documents)
-        except IndexError:
-            pass
-    total_time = time.time() - start_time
-    print("time: ", total_time)
-    print("avg time:: ", total_time / len(image_path_list))
-
-    txt_save_path = os.path.join(save_dir, "time.txt")
-    with open(txt_save_path, "w") as f:
-        f.write("time: {}\n".format(total_time))
-        f.write("avg time: {}\n".format(total_time / len(image_path_list)))
-
-
-def infer_upstage(image_dir, save_dir):
-    endpoint = "https://api.upstage.ai/v1/document-ai/document-parse"
-    headers = {
-        "Authorization": f"Bearer {UPSTAGE_API_KEY}",
-    }
-    output_formats = ["text", "html", "markdown"]
-    data = {
-        "ocr": "force",
-        "model": "document-parse-240910",
-        "output_formats": f"{output_formats}"
-    }
-
-    start_time = time.time()
-    image_path_list = get_image_path_list(image_dir)
-    for image_path in tqdm(image_path_list):
-
-        files = {
-            "document": open(image_path, "rb"),
-        }
-
-        response = requests.post(
-            endpoint,
-            headers=headers,
-            files=files,
-            data=data
-        )
-        json_result = response.json()
-        save_txt(image_path, image_dir, save_dir, json_result["content"]["markdown"])
-
-    total_time = time.time() - start_time
-    print("time: ", total_time)
-    print("avg time:: ", total_time / len(image_path_list))
-
-    txt_save_path = os.path.join(save_dir, "time.txt")
-    with open(txt_save_path, "w") as f:
-        f.write("time: {}\n".format(total_time))
-        f.write("avg time: {}\n".format(total_time / len(image_path_list)))
+            if cache is None:
+                content = parse(image_path, input_hash)
+            else:
+                # parse() marks the record as sent on a cache miss
+                timing.set_status("cached")
+                content = cache.get_or_call(input_hash, parse, image_path, input_hash)
+        except Exception as exc:
+            if dead_letters is None:
+                raise
+            timing.set_status("error")
+            dead_letters.add(item, exc)
+            return None
+
+        if content is not None and normalize:
+            # the cache keeps the raw response; tables are normalized on the way out
+            with timing.phase("normalize"):
+                content = normalize_tables(content)
+        if content is not None:
+            save_content(image_path, item, input_hash, content)
+        return content
+
+    def save_content(image_path, item, input_hash, content):
+        with timing.phase("write"):
+            if store is None:
+                save_path = save_txt(image_path, image_dir, save_dir, content)
+            else:
+                save_path = store.append("content", item, content=content, provider=provider.name)
+            if manifest is not None:
+                manifest.mark_done(item, input_hash, output=save_path)
 
+    cost = None
+    if provider.tokens_per_page:
+        cost = lambda image_path: provider.tokens_per_page
 
-def infer_unstructured(image_dir, save_dir):
     start_time = time.time()
-
-    client = unstructured_client.UnstructuredClient(
-        api_key_auth=UNSTRUCTURED_API_KEY,
-        server_url="https://api.unstructuredapp.io/general/v0/general",
-    )
-    image_path_list = get_image_path_list(image_dir)
-    for image_path in tqdm(image_path_list):
-        with open(image_path, "rb") as f:
-            data = f.read()
-
-        req = operations.PartitionRequest(
-            partition_parameters=shared.PartitionParameters(
-                files=shared.Files(
-                    content=data,
-                    file_name=str(image_path),
-                ),
-                # --- Other partition parameters ---
-                strategy=shared.Strategy.HI_RES,
-                pdf_infer_table_structure=True,
-                coordinates=True,
-                languages=["eng", "kor"],
-            ),
+    if image_path_list is None:
+        image_path_list = get_image_path_list(image_dir)
+    if preprocess_options is not None:
+        prepared, duplicates = preprocess_images(image_path_list, preprocess_options, preprocess_processes)
+    unique_paths = [image_path for image_path in image_path_list if image_path not in duplicates]
+
+    def process_duplicate(image_path):
+        # parsed only if the first copy produced nothing in this run
+        return process(image_path, content=contents.get(duplicates[image_path]))
+
+    contents = {}
+
+    async def run_passes():
+        # both passes share one event loop, and with it the rate limiter and
+        # adaptive concurrency state
+        results = await run_tasks(
+            unique_paths, process,
+            concurrency=concurrency,
+            rate_limiter=rate_limiter,
+            cost=cost,
         )
-
-        res = client.general.partition(request=req)
-        elements = res.elements
-        texts = ""
-        for elem in elements:
-            text = elem["text"]
-
-            texts += text + "\n"
-
-        save_txt(image_path, image_dir, save_dir, texts)
-
+        contents.update(zip(unique_paths, results))
+        if duplicates:
+            await run_tasks(
+                [image_path for image_path in image_path_list if image_path in duplicates],
+                process_duplicate,
+                concurrency=concurrency,
+                rate_limiter=rate_limiter,
+                cost=cost,
+            )
+
+    provider.setup()
+    try:
+        asyncio.run(run_passes())
+    finally:
+        provider.teardown()
+        if store is not None:
+            store.close()
     total_time = time.time() - start_time
+    # an empty shard or dead-letter replay has nothing to average over
+    avg_time = total_time / len(image_path_list) if image_path_list else 0.0
     print("time: ", total_time)
-    print("avg time:: ", total_time / len(image_path_list))
+    print("avg time:: ", avg_time)
+    if dead_letters is not None and len(dead_letters):
+        print("failed: {} (see {}, rerun with --replay_dead_letters)".format(len(dead_letters), dead_letters.path))
 
     txt_save_path = os.path.join(save_dir, "time.txt")
-    with open(txt_save_path, "w") as f:
-        f.write("time: {}\n".format(total_time))
-        f.write("avg time: {}\n".format(total_time / len(image_path_list)))
-
-
-def infer_aws(image_dir, save_dir):
-    def start_job(object_name):
-        filename_with_ext = os.path.basename(object_name)
-
-        s3.Bucket(s3_bucket_name).upload_file(object_name, filename_with_ext)
-
-        response = None
-        response = client.start_document_analysis(
-            DocumentLocation={
-                "S3Object": {
-                    "Bucket": s3_bucket_name,
-                    "Name": filename_with_ext
-                }
-            },
-            FeatureTypes = ["LAYOUT", "TABLES"]
-        )
-
-        return response["JobId"]
-
-    def is_job_complete(job_id):
-        time.sleep(1)
-        response = client.get_document_analysis(JobId=job_id)
-        status = response["JobStatus"]
-        print("Job status: {}".format(status))
-
-        while(status == "IN_PROGRESS"):
-            time.sleep(1)
-            response = client.get_document_analysis(JobId=job_id)
-            status = response["JobStatus"]
-            print("Job status: {}".format(status))
-
-        return status
-
-    def get_job_results(job_id):
-        pages = []
-        time.sleep(1)
-        response = client.get_document_analysis(JobId=job_id)
-        pages.append(response)
-        print("Resultset page received: {}".format(len(pages)))
-        next_token = None
-        if "NextToken" in response:
-            next_token = response["NextToken"]
-
-        while next_token:
-            time.sleep(1)
-            response = client.\
-                get_document_analysis(JobId=job_id, NextToken=next_token)
-            pages.append(response)
-            print("Resultset page received: {}".format(len(pages)))
-            next_token = None
-            if "NextToken" in response:
-                next_token = response["NextToken"]
-
-        return pages
-
-    def post_process(data):
-        def get_text(result, blocks_map):
-            text = ""
-            if "Relationships" in result:
-                for relationship in result["Relationships"]:
-                    if relationship["Type"] == "CHILD":
-                        for child_id in relationship["Ids"]:
-                            word = blocks_map[child_id]
-                            if word["BlockType"] == "WORD":
-                                text += " " + word["Text"]
-            return text[1:]
-
-        all_elems = {}
-        for elem in data["Blocks"]:
-            _id = elem["Id"]
-            all_elems[_id] = elem
-
-        processed_list = []
-        for idx, elem in enumerate(data["Blocks"]):
-            if elem["BlockType"] == "LAYOUT_LIST":
-                continue
-
-            if "LAYOUT" in elem["BlockType"] and elem["BlockType"] != "LAYOUT_TABLE":
-
-                bbox = elem["Geometry"]["BoundingBox"]
-
-                x = bbox["Left"]
-                y = bbox["Top"]
-                w = bbox["Width"]
-                h = bbox["Height"]
-
-                coord = [
-                    [x, y],
-                    [x + w, y],
-                    [x + w, y + h],
-                    [x, y + h]
-                ]
-                xy_coord = [{"x": x, "y": y} for x, y in coord]
-
-                # category = CATEGORY_MAP.get(elem["BlockType"], "paragraph")
-                category = elem["BlockType"]
-
-                transcription = ""
-
-                if elem["BlockType"] != "LAYOUT_FIGURE":
-                    for item in all_elems[elem["Id"]]["Relationships"]:
-                        for id_ in item["Ids"]:
-                            if all_elems[id_]["BlockType"] == "LINE":
-                                word = all_elems[id_]["Text"]
-                                transcription += word + "\n"
-
-                data_dict = {
-                    "coordinates": xy_coord,
-                    "category": category,
-                    "id": idx,
-                    "content": {
-                        "text": transcription,
-                        "html": "",
-                        "markdown": ""
-                    }
-                }
-                processed_list.append(data_dict)
-
-            elif elem["BlockType"] == "TABLE":
-
-                bbox = elem["Geometry"]["BoundingBox"]
-
-                x = bbox["Left"]
-                y = bbox["Top"]
-                w = bbox["Width"]
-                h = bbox["Height"]
-
-                coord = [
-                    [x, y],
-                    [x + w, y],
-                    [x + w, y + h],
-                    [x, y + h]
-                ]
-                xy_coord = [{"x": x, "y": y} for x, y in coord]
-
-                # category = CATEGORY_MAP.get(elem["BlockType"], "paragraph")
-                category = elem["BlockType"]
-
-                table_cells = {}
-                for relationship in elem["Relationships"]:
-                    if relationship["Type"] == "CHILD":
-                        for cell_id in relationship["Ids"]:
-                            cell_block = next((block for block in data["Blocks"] if block["Id"] == cell_id), None)
-                            if cell_block is not None and cell_block["BlockType"] == "CELL":
-                                row_index = cell_block["RowIndex"] - 1
-                                column_index = cell_block["ColumnIndex"] - 1
-                                row_span = cell_block["RowSpan"]
-                                column_span = cell_block["ColumnSpan"]
-                                table_cells[(row_index, column_index)] = {
-                                    "block": cell_block,
-                                    "span": (row_span, column_span),
-                                    "text": get_text(cell_block, all_elems),
-                                }
-                max_row_index = max(cell[0] for cell in table_cells.keys())
-                max_column_index = max(cell[1] for cell in table_cells.keys())
-                for relationship in elem["Relationships"]:
-                    if relationship["Type"] == "MERGED_CELL":
-                        for cell_id in relationship["Ids"]:
-                            cell_block = next((block for block in data["Blocks"] if block["Id"] == cell_id), None)
-                            if cell_block is not None and cell_block["BlockType"] == "MERGED_CELL":
-                                row_index = cell_block["RowIndex"] - 1
-                                column_index = cell_block["ColumnIndex"] - 1
-                                row_span = cell_block["RowSpan"]
-                                column_span = cell_block["ColumnSpan"]
-                                for i in range(row_span):
-                                    for j in range(column_span):
-                                        del table_cells[(row_index + i, column_index + j)]
-                                text = ""
-                                for child_ids in cell_block["Relationships"][0]["Ids"]:
-                                    child_cell_block = next((block for block in data["Blocks"] if block["Id"] == child_ids), None)
-                                    text += " " + get_text(child_cell_block, all_elems)
-                                table_cells[(row_index, column_index)] = {
-                                    "block": cell_block,
-                                    "span": (row_span, column_span),
-                                    "text": text[1:],
-                                }
-                html_table = "<table>"
-
-                for row_index in range(max_row_index + 1):
-                    html_table += "<tr>"
-                    for column_index in range(max_column_index + 1):
-                        cell_data = table_cells.get((row_index, column_index))
-                        if cell_data:
-                            cell_block = cell_data["block"]
-                            row_span, column_span = cell_data["span"]
-
-                            cell_text = cell_data["text"]
-                            html_table += f"<td rowspan='{row_span}' colspan='{column_span}''>{cell_text}</td>"
-                    html_table += "</tr>"
-                html_table += "</table>"
-
-                data_dict = {
-                    "coordinates": xy_coord,
-                    "category": category,
-                    "id": idx,
-                    "content": {
-                        "text": "",
-                        "html": html_table,
-                        "markdown": ""
-                    }
-                }
-                processed_list.append(data_dict)
-
-        return processed_list
-
-    s3 = boto3.resource("s3")
-
-    client = boto3.client(
-        "textract",
-        region_name=AWS_REGION,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+    atomic_write(
+        txt_save_path,
+        "time: {}\n".format(total_time) + "avg time: {}\n".format(avg_time)
     )
 
-    start_time = time.time()
-    image_path_list = get_image_path_list(image_dir)
-    for image_path in tqdm(image_path_list):
-
-        # for PDF input file
-        # job_id = start_job(filepath)
-        # print("Started job with id: {}".format(job_id))
-        # if is_job_complete(job_id):
-        #     result = get_job_results(job_id)
-
-        with open(image_path, "rb") as file:
-            img_test = file.read()
-            bytes_test = bytearray(img_test)
-
-        result = client.analyze_document(
-            Document={"Bytes": bytes_test},
-            FeatureTypes = ["LAYOUT", "TABLES"]
-        )
-
-        processed_list = post_process(result)
-
-        texts = ""
-        for elem in processed_list:
-            if elem["content"]["html"]:
-                text = pyhtml2md.convert(elem["content"]["html"]) + "\n"
-            else:
-                text = elem["content"]["text"] + "\n"
-
-            texts += text
-
-        save_txt(image_path, image_dir, save_dir, texts)
-
-    total_time = time.time() - start_time
-    print("time: ", total_time)
-    print("avg time:: ", total_time / len(image_path_list))
-
-    txt_save_path = os.path.join(save_dir, "time.txt")
-    with open(txt_save_path, "w") as f:
-        f.write("time: {}\n".format(total_time))
-        f.write("avg time: {}\n".format(total_time / len(image_path_list)))
+    if timing_log is not None:
+        timing.write_report(timing_log, save_dir, parquet=timing_parquet)
 
 
 if __name__ == "__main__":
@@ -459,6 +162,7 @@ if __name__ == "__main__":
         "--model",
         type=str,
         default="llamaparse",
+        choices=sorted(PROVIDERS),
         help="Model name to use."
     )
     args.add_argument(
@@ -467,20 +171,251 @@ if __name__ == "__main__":
         default="results",
         help="Directory to save the results."
     )
+    args.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Maximum number of in-flight provider requests."
+    )
+    args.add_argument(
+        "--adaptive_concurrency",
+        action="store_true",
+        help="Start at --concurrency and adjust the number of in-flight requests to the provider's latency and throttling."
+    )
+    args.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=None,
+        help="Upper bound for --adaptive_concurrency (defaults to 4x --concurrency)."
+    )
+    args.add_argument(
+        "--requests_per_second",
+        type=float,
+        default=None,
+        help="Override the provider request rate limit."
+    )
+    args.add_argument(
+        "--tokens_per_minute",
+        type=float,
+        default=None,
+        help="Override the provider token rate limit."
+    )
+    args.add_argument(
+        "--cache_path",
+        type=str,
+        default=".cache/responses.sqlite",
+        help="Response cache database. Pass an empty string to disable caching."
+    )
+    args.add_argument(
+        "--cache_max_mb",
+        type=float,
+        default=1024,
+        help="Evict least recently used responses above this size."
+    )
+    args.add_argument(
+        "--rerun",
+        action="store_true",
+        help="Ignore the run manifest and reprocess every image."
+    )
+    args.add_argument(
+        "--pool_size",
+        type=int,
+        default=None,
+        help="HTTP connection pool size (defaults to --concurrency)."
+    )
+    args.add_argument(
+        "--timeout",
+        type=float,
+        default=60,
+        help="HTTP request timeout in seconds."
+    )
+    args.add_argument(
+        "--no_http2",
+        action="store_true",
+        help="Disable HTTP/2 even when it is available."
+    )
+    args.add_argument(
+        "--endpoint_url",
+        type=str,
+        default=None,
+        help="Send provider requests to this URL instead, e.g. a local mock server."
+    )
+    args.add_argument(
+        "--max_attempts",
+        type=int,
+        default=5,
+        help="Attempts per image before it is moved to the dead-letter list."
+    )
+    args.add_argument(
+        "--replay_dead_letters",
+        action="store_true",
+        help="Only reprocess the images that failed in a previous run."
+    )
+    args.add_argument(
+        "--result_store",
+        type=str,
+        default=None,
+        help="Append extracted contents to this JSONL store instead of writing one .txt file per image."
+    )
+    args.add_argument(
+        "--no_recursive",
+        action="store_true",
+        help="Only read images directly in --image_dir, not in its subdirectories."
+    )
+    args.add_argument(
+        "--preprocess",
+        action="store_true",
+        help="Downscale and recompress images and skip duplicates before upload (needs Pillow)."
+    )
+    args.add_argument(
+        "--max_image_side",
+        type=int,
+        default=None,
+        help="Longest image side in pixels after preprocessing (defaults to the provider's limit)."
+    )
+    args.add_argument(
+        "--max_dpi",
+        type=float,
+        default=None,
+        help="Downscale images whose recorded DPI is higher than this."
+    )
+    args.add_argument(
+        "--image_format",
+        type=str,
+        default="keep",
+        choices=["keep", "png", "jpeg", "webp"],
+        help="Re-encode preprocessed images in this format."
+    )
+    args.add_argument(
+        "--image_quality",
+        type=int,
+        default=85,
+        help="JPEG/WebP quality of preprocessed images."
+    )
+    args.add_argument(
+        "--dedupe",
+        type=str,
+        default="exact",
+        choices=["none", "exact", "perceptual"],
+        help="Skip byte-identical images, or also images with nearly identical perceptual hashes."
+    )
+    args.add_argument(
+        "--preprocess_processes",
+        type=int,
+        default=None,
+        help="Worker processes for preprocessing (defaults to the number of CPUs)."
+    )
+    args.add_argument(
+        "--raw_tables",
+        action="store_true",
+        help="Save tables as the provider returned them instead of as canonical markdown tables."
+    )
+    args.add_argument(
+        "--timing_parquet",
+        action="store_true",
+        help="Also write the per-image timing records to timing.parquet (needs pandas and pyarrow)."
+    )
+    args.add_argument(
+        "--record_fixtures",
+        type=str,
+        default=None,
+        help="Append every provider response and its latency to this JSON lines file, for mock_server.py --fixtures."
+    )
+    args.add_argument(
+        "--replay_provider",
+        type=str,
+        default="upstage",
+        choices=sorted(PROVIDERS),
+        help="With --model replay, the provider whose recorded responses mock_server.py replays."
+    )
+    args.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="Process only shard i of N ('i/N'), with outputs in <save_dir>/shard-i-of-N."
+    )
+    args.add_argument(
+        "--merge_shards",
+        type=int,
+        default=None,
+        help="Merge the timing (and --result_store) of N shards in --save_dir instead of running."
+    )
     args = args.parse_args()
 
-    start_t = time.perf_counter()
-    if args.model == "llamaparse":
-        infer_llamaparse(args.image_dir, args.save_dir)
-    elif args.model == "sonnet":
-        infer_sonnet(args.image_dir, args.save_dir)
-    elif args.model == "gpt4o":
-        infer_gpt4o(args.image_dir, args.save_dir)
-    elif args.model == "upstage":
-        infer_upstage(args.image_dir, args.save_dir)
-    elif args.model == "unstructured":
-        infer_unstructured(args.image_dir, args.save_dir)
-    elif args.model == "aws":
-        infer_aws(args.image_dir, args.save_dir)
+    if args.merge_shards:
+        timing.merge_reports(
+            args.save_dir,
+            [shard_dir(args.save_dir, (index, args.merge_shards)) for index in range(args.merge_shards)],
+            parquet=args.timing_parquet,
+        )
+        if args.result_store:
+            records = merge_stores(
+                args.result_store,
+                [shard_path(args.result_store, (index, args.merge_shards)) for index in range(args.merge_shards)],
+            )
+            print("Merged {} records into {}".format(records, args.result_store))
+        exit(0)
+    if args.shard:
+        args.save_dir = shard_dir(args.save_dir, args.shard)
+        if args.result_store:
+            args.result_store = shard_path(args.result_store, args.shard)
+
+    concurrency = args.concurrency
+    if args.adaptive_concurrency:
+        concurrency = AdaptiveConcurrency(
+            initial=args.concurrency, maximum=args.max_concurrency or 4 * args.concurrency
+        )
+
+    provider = get_provider(
+        args.model,
+        pool_size=args.pool_size or slots(concurrency)[0],
+        timeout=args.timeout,
+        http2=not args.no_http2,
+        endpoint_url=args.endpoint_url,
+        **({"replay_provider": args.replay_provider} if args.model == "replay" else {})
+    )
+    rate_limiter = RateLimiter(
+        requests_per_second=args.requests_per_second or provider.requests_per_second,
+        tokens_per_minute=args.tokens_per_minute or provider.tokens_per_minute,
+    )
+    cache = open_cache(args.cache_path, args.cache_max_mb)
+    dead_letters = open_dead_letters(args.save_dir)
+
+    preprocess_options = None
+    if args.preprocess:
+        preprocess_options = PreprocessOptions(
+            max_side=args.max_image_side or provider.max_image_side,
+            max_dpi=args.max_dpi,
+            image_format=args.image_format,
+            quality=args.image_quality,
+            dedupe=args.dedupe,
+        )
+
+    if args.replay_dead_letters:
+        image_path_list = [os.path.join(args.image_dir, item) for item in dead_letters.take()]
     else:
-        raise ValueError("Invalid model name")
+        image_path_list = get_image_path_list(args.image_dir, recursive=not args.no_recursive, shard=args.shard)
+
+    run_extraction(
+        args.image_dir, args.save_dir, provider,
+        concurrency=concurrency,
+        rate_limiter=rate_limiter,
+        cache=cache,
+        manifest=open_manifest(args.save_dir, rerun=args.rerun),
+        policy=RetryPolicy(max_attempts=args.max_attempts),
+        breaker=CircuitBreaker(),
+        dead_letters=dead_letters,
+        image_path_list=image_path_list,
+        timing_log=timing.open_timing_log(args.save_dir),
+        timing_parquet=args.timing_parquet,
+        store=ResultStore(args.result_store) if args.result_store else None,
+        preprocess_options=preprocess_options,
+        preprocess_processes=args.preprocess_processes,
+        recorder=open_recorder(args.record_fixtures),
+        normalize=not args.raw_tables,
+    )
+
+    if args.replay_dead_letters:
+        dead_letters.finish_replay()
+    distributed.report(dead_letters=len(dead_letters))
+    print_stats(cache)
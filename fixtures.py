@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import random
+import threading
+
+
+class FixtureRecorder:
+    # appends real provider and OpenAI responses with their latencies as JSON
+    # lines, keyed like the response cache, for mock_server.py --fixtures
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+    def add(self, kind, key, content, latency, **fields):
+        record = {"kind": kind, "key": key, "content": content, "latency": latency}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+
+def timed_call(fn):
+    # fn returning (result, seconds), so retries and backoff are not counted
+    # in the recorded latency
+    def wrapper(*args, **kwargs):
+        start = time.monotonic()
+        result = fn(*args, **kwargs)
+        return result, time.monotonic() - start
+    return wrapper
+
+
+def open_recorder(path):
+    return FixtureRecorder(path) if path else None
+
+
+class Fixtures:
+    # recorded responses by kind and key, with every recorded latency of a
+    # kind to sample from for requests that were not recorded
+    def __init__(self, paths=()):
+        self.records = {}
+        self.latencies = {}
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.records[(record["kind"], record["key"])] = record
+                    self.latencies.setdefault(record["kind"], []).append(record["latency"])
+
+    def get(self, kind, key):
+        return self.records.get((kind, key))
+
+    def __len__(self):
+        return len(self.records)
+
+
+class LoadProfile:
+    # how the mock server delays and fails requests:
+    #   latency  "recorded", "none", "fixed:S", "uniform:A,B" or
+    #            "lognormal:MEDIAN,SIGMA" (seconds), times latency_scale
+    #   error_rate     fraction of requests answered with a 500
+    #   throttle_rate  fraction of requests answered with a 429
+    #   throttle_rps   requests per second allowed before answering 429
+    def __init__(
+        self, latency="recorded", latency_scale=1.0, error_rate=0.0,
+        throttle_rate=0.0, throttle_rps=None, seed=None
+    ):
+        name, _, params = latency.partition(":")
+        if name not in ("recorded", "none", "fixed", "uniform", "lognormal"):
+            raise ValueError("Unknown latency distribution: {}".format(latency))
+        self.latency = name
+        self.params = [float(param) for param in params.split(",") if param]
+        self.latency_scale = latency_scale
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.throttle_rps = throttle_rps
+        self.random = random.Random(seed)
+        self._tokens = throttle_rps or 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def delay(self, kind, record=None, fixtures=None):
+        with self._lock:
+            if self.latency == "recorded":
+                if record is not None:
+                    seconds = record["latency"]
+                elif fixtures is not None and fixtures.latencies.get(kind):
+                    seconds = self.random.choice(fixtures.latencies[kind])
+                else:
+                    seconds = 0.0
+            elif self.latency == "fixed":
+                seconds = self.params[0]
+            elif self.latency == "uniform":
+                seconds = self.random.uniform(*self.params)
+            elif self.latency == "lognormal":
+                median, sigma = self.params
+                seconds = self.random.lognormvariate(0.0, sigma) * median
+            else:
+                seconds = 0.0
+        return seconds * self.latency_scale
+
+    def failure(self):
+        # (status code, Retry-After seconds) for a request to fail, or None
+        with self._lock:
+            if self.throttle_rps:
+                now = time.monotonic()
+                self._tokens = min(self.throttle_rps, self._tokens + (now - self._updated) * self.throttle_rps)
+                self._updated = now
+                if self._tokens < 1:
+                    return 429, (1 - self._tokens) / self.throttle_rps
+                self._tokens -= 1
+            if self.throttle_rate and self.random.random() < self.throttle_rate:
+                return 429, 1.0
+            if self.error_rate and self.random.random() < self.error_rate:
+                return 500, None
+        return None
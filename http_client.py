@@ -0,0 +1,55 @@
+import importlib.util
+
+
+def http2_available():
+    return importlib.util.find_spec("h2") is not None
+
+
+class HttpClient:
+    # one pooled, keep-alive client shared by every worker thread; uses
+    # httpx (streamed multipart uploads, HTTP/2 when h2 is installed) and
+    # falls back to a pooled requests.Session
+    def __init__(self, pool_size=16, timeout=60, http2=True):
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        try:
+            import httpx
+        except ImportError:
+            httpx = None
+
+        if httpx is not None:
+            self.backend = "httpx"
+            self.http2 = http2 and http2_available()
+            self.client = httpx.Client(
+                http2=self.http2,
+                timeout=timeout,
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size,
+                ),
+            )
+        else:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self.backend = "requests"
+            self.http2 = False
+            self.client = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.client.mount("https://", adapter)
+            self.client.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        if self.backend == "requests":
+            kwargs.setdefault("timeout", self.timeout)
+        return self.client.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,130 @@
+import math
+import re
+import threading
+import unicodedata
+
+NUMBER_PATTERN = re.compile(r"[-+]?(?:\d[\d,]*(?:\.\d+)?|\.\d+)")
+THOUSANDS_PATTERN = re.compile(r"^[-+]?\d{1,3}(?:,\d{3})+(?:\.\d+)?$")
+UNIT_PATTERN = re.compile(r"[^\W\d_]+|[%$€£¥]")
+DIGIT_PATTERN = re.compile(r"\d")
+YES_NO = {"yes", "no"}
+# ratios between two values that may be one number in different scales,
+# e.g. 0.5 vs 50 (percent) or 1,200 vs 1.2 (thousands)
+SCALE_FACTORS = (100, 1000)
+
+# text allowed around a number for it to still count as "the number with a unit"
+MAX_UNIT_WORDS = 1
+
+
+def normalize_text(text):
+    text = unicodedata.normalize("NFKC", str(text)).replace("\u2212", "-")
+    return " ".join(text.lower().split())
+
+
+def fold(text):
+    return "".join(ch for ch in normalize_text(text) if ch.isalnum())
+
+
+def parse_number(text):
+    # (value, unit words and symbols) for a single number with at most one
+    # unit word, e.g. "-5%" or "5 million"; None when the text is anything else
+    text = normalize_text(text)
+    numbers = NUMBER_PATTERN.findall(text)
+    if len(numbers) != 1:
+        return None
+
+    residue = NUMBER_PATTERN.sub(" ", text, count=1)
+    if "/" in residue or "." in residue.strip(" ."):
+        return None
+    units = tuple(UNIT_PATTERN.findall(residue))
+    if len(units) > MAX_UNIT_WORDS + 1:
+        return None
+
+    number = numbers[0]
+    if "," in number:
+        # only thousands separators; "1,25" may be a decimal comma
+        if not THOUSANDS_PATTERN.match(number):
+            return None
+        number = number.replace(",", "")
+    try:
+        return float(number), units
+    except ValueError:
+        return None
+
+
+def is_scaled(a, b):
+    if not a or not b:
+        return False
+    ratio = max(abs(a), abs(b)) / min(abs(a), abs(b))
+    return any(math.isclose(ratio, factor) for factor in SCALE_FACTORS)
+
+
+def score_pair(reference, answer):
+    # 1 or 0 when the pair is clearly decidable, None when it needs the judge
+    reference = "" if reference is None else str(reference)
+    answer = "" if answer is None else str(answer)
+
+    if normalize_text(reference) == normalize_text(answer):
+        return 1
+    if not fold(answer):
+        return 0
+
+    if DIGIT_PATTERN.search(reference) or DIGIT_PATTERN.search(answer):
+        # numbers are compared by value, sign and unit, never as folded text
+        reference_number = parse_number(reference)
+        answer_number = parse_number(answer)
+        if reference_number is None or answer_number is None:
+            return None
+        (reference_value, reference_units), (answer_value, answer_units) = reference_number, answer_number
+        # different units (5 million vs 5 billion, 0.5 vs 50%) or values a
+        # scale factor apart go to the judge; other differing values score 0
+        if reference_units != answer_units:
+            return None
+        if reference_value == answer_value:
+            return 1
+        if is_scaled(reference_value, answer_value):
+            return None
+        return 0
+
+    if fold(reference) == fold(answer):
+        return 1
+    if fold(reference) in YES_NO and fold(answer) in YES_NO:
+        return 0
+
+    return None
+
+
+def score_locally(reference_answers, model_answers):
+    return [
+        score_pair(reference, answer)
+        for reference, answer in zip(reference_answers, model_answers)
+    ]
+
+
+def merge_scores(local_scores, judge_scores):
+    judge_scores = iter(judge_scores)
+    return [next(judge_scores) if score is None else score for score in local_scores]
+
+
+class ScoringReport:
+    def __init__(self):
+        self.documents = 0
+        self.documents_without_judge = 0
+        self.pairs = 0
+        self.pairs_decided = 0
+        self._lock = threading.Lock()
+
+    def record(self, local_scores):
+        decided = sum(score is not None for score in local_scores)
+        with self._lock:
+            self.documents += 1
+            self.pairs += len(local_scores)
+            self.pairs_decided += decided
+            if decided == len(local_scores):
+                self.documents_without_judge += 1
+
+    def summary(self):
+        return (
+            "local scorer: decided {} of {} answers, avoided {} of {} judge calls"
+            .format(self.pairs_decided, self.pairs, self.documents_without_judge, self.documents)
+        )
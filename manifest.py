@@ -0,0 +1,60 @@
+import os
+import json
+import threading
+
+
+class RunManifest:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a run killed mid-append leaves a partial last line
+                        continue
+                    self.entries[entry["item"]] = entry
+
+    def get(self, item, input_hash):
+        entry = self.entries.get(item)
+        if entry is None or entry["input_hash"] != input_hash:
+            return None
+        output = entry.get("output")
+        if output is not None and not os.path.exists(output):
+            return None
+        return entry
+
+    def is_done(self, item, input_hash):
+        return self.get(item, input_hash) is not None
+
+    def mark_done(self, item, input_hash, **extra):
+        entry = {"item": item, "input_hash": input_hash}
+        entry.update(extra)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[item] = entry
+        return entry
+
+    def snapshot(self, items=None):
+        with self._lock:
+            if items is None:
+                return list(self.entries.values())
+            return [self.entries[item] for item in items if item in self.entries]
+
+
+def open_manifest(save_dir, rerun=False):
+    path = os.path.join(save_dir, "manifest.jsonl")
+    if rerun and os.path.exists(path):
+        os.remove(path)
+    return RunManifest(path)
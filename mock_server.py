@@ -0,0 +1,389 @@
+import re
+import ast
+import json
+import time
+import uuid
+import argparse
+import threading
+
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cache import make_key
+from fixtures import Fixtures, LoadProfile
+
+
+def default_completion(body):
+    # canned but well-formed answers for the prompts run_qa_eval.py sends
+    prompt = body["messages"][-1]["content"]
+
+    if "# Documents:" in prompt:
+        documents = json.loads(re.search(r"```json\n(.*?)\n```", prompt, re.S).group(1))
+        return json.dumps({"documents": [
+            {"id": document["id"], "scores": [1] * len(document["model_answers"])}
+            for document in documents
+        ]})
+
+    if "# Model Answers:" in prompt:
+        model_answers = re.search(r"# Model Answers:\s*```list\n(.*?)\n```", prompt, re.S).group(1)
+        return "```list\n{}\n```".format([1] * len(ast.literal_eval(model_answers)))
+
+    match = re.search(r"# Questions:\s*```json\n(.*?)\n```", prompt, re.S)
+    if match:
+        questions = json.loads(match.group(1))
+        return "```json\n{}\n```".format(json.dumps(questions, indent=2))
+
+    return ""
+
+
+def chat_key(body):
+    # the key run_qa_eval.py records chat responses under
+    messages = {message["role"]: message["content"] for message in body["messages"]}
+    return make_key("chat", body.get("model", ""), messages.get("system"), messages.get("user"), body.get("response_format"))
+
+
+def chat_completion_response(body, content, usage=None):
+    return {
+        "id": "chatcmpl-" + uuid.uuid4().hex,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", ""),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": usage or {
+            "prompt_tokens": sum(len(message["content"]) for message in body["messages"]) // 4,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": 0,
+        },
+    }
+
+
+def textract_blocks(name, n_pages=2):
+    # a title, a paragraph and a 2x2 table per page
+    blocks = []
+    counter = iter(range(10 ** 9))
+
+    def add(block_type, **fields):
+        block = {"Id": "{}-{}".format(block_type.lower(), next(counter)), "BlockType": block_type}
+        block.update(fields)
+        blocks.append(block)
+        return block["Id"]
+
+    def geometry():
+        return {"BoundingBox": {"Left": 0.1, "Top": 0.1, "Width": 0.8, "Height": 0.1}}
+
+    def line(text, page):
+        word_ids = [add("WORD", Text=word, Page=page) for word in text.split()]
+        return add("LINE", Text=text, Page=page, Relationships=[{"Type": "CHILD", "Ids": word_ids}])
+
+    for page in range(1, n_pages + 1):
+        title = line("{} page {}".format(name, page), page)
+        add("LAYOUT_TITLE", Page=page, Geometry=geometry(), Relationships=[{"Type": "CHILD", "Ids": [title]}])
+        text = line("Mock text for page {}".format(page), page)
+        add("LAYOUT_TEXT", Page=page, Geometry=geometry(), Relationships=[{"Type": "CHILD", "Ids": [text]}])
+
+        cell_ids = []
+        for row in (1, 2):
+            for column in (1, 2):
+                word = add("WORD", Text="r{}c{}".format(row, column), Page=page)
+                cell_ids.append(add(
+                    "CELL", Page=page, RowIndex=row, ColumnIndex=column, RowSpan=1, ColumnSpan=1,
+                    Relationships=[{"Type": "CHILD", "Ids": [word]}]
+                ))
+        add("TABLE", Page=page, Geometry=geometry(), Relationships=[{"Type": "CHILD", "Ids": cell_ids}])
+
+    return blocks
+
+
+class MockState:
+    def __init__(self, completion=default_completion, batch_delay=1.0, job_delay=2.0, fixtures=None, profile=None):
+        self.completion = completion
+        self.batch_delay = batch_delay
+        self.job_delay = job_delay
+        # recorded responses to replay, and the latency and failures to add
+        self.fixtures = fixtures or Fixtures()
+        self.profile = profile or LoadProfile()
+        self.files = {}
+        self.batches = {}
+        self.objects = {}
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def start_job(self, request):
+        location = request["DocumentLocation"]["S3Object"]
+        key = "{}/{}".format(location["Bucket"], location["Name"])
+        if key not in self.objects:
+            return None
+
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = {"started": time.time(), "blocks": textract_blocks(location["Name"])}
+        return job_id
+
+    def get_job(self, request):
+        job = self.jobs.get(request["JobId"])
+        if job is None:
+            return None
+        if time.time() - job["started"] < self.job_delay:
+            return {"JobStatus": "IN_PROGRESS", "Blocks": []}
+
+        start = int(request.get("NextToken") or 0)
+        end = start + min(request.get("MaxResults", 1000), 1000)
+        response = {
+            "JobStatus": "SUCCEEDED",
+            "DocumentMetadata": {"Pages": 2},
+            "Blocks": job["blocks"][start:end],
+        }
+        if end < len(job["blocks"]):
+            response["NextToken"] = str(end)
+        return response
+
+    def add_file(self, content, filename, purpose):
+        file_id = "file-" + uuid.uuid4().hex
+        with self.lock:
+            self.files[file_id] = {
+                "object": {
+                    "id": file_id,
+                    "object": "file",
+                    "bytes": len(content),
+                    "created_at": int(time.time()),
+                    "filename": filename,
+                    "purpose": purpose,
+                    "status": "processed",
+                },
+                "content": content,
+            }
+        return self.files[file_id]["object"]
+
+    def create_batch(self, request):
+        batch_id = "batch_" + uuid.uuid4().hex
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"],
+            "completion_window": request["completion_window"],
+            "status": "validating",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Thread(target=self.process_batch, args=(batch_id,), daemon=True).start()
+        return batch
+
+    def process_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        lines = self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines()
+        batch["request_counts"]["total"] = len(lines)
+        batch["status"] = "in_progress"
+        time.sleep(self.batch_delay)
+
+        outputs = []
+        for line in lines:
+            request = json.loads(line)
+            content = self.completion(request["body"])
+            outputs.append(json.dumps({
+                "id": "batch_req_" + uuid.uuid4().hex,
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "request_id": uuid.uuid4().hex,
+                    "body": chat_completion_response(request["body"], content),
+                },
+                "error": None,
+            }))
+            batch["request_counts"]["completed"] += 1
+
+        output = self.add_file(("\n".join(outputs) + "\n").encode("utf-8"), "output.jsonl", "batch_output")
+        batch["output_file_id"] = output["id"]
+        batch["status"] = "completed"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_bytes(self, data, content_type="application/octet-stream"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def delay_or_fail(self, kind, record=None):
+        # answers with a 429 or 500 and returns True if the load profile
+        # fails this request, otherwise waits for its latency
+        failure = self.state.profile.failure()
+        if failure is not None:
+            status, retry_after = failure
+            headers = {"Retry-After": "{:.3f}".format(retry_after)} if retry_after is not None else None
+            message = "Rate limit exceeded" if status == 429 else "Mock server error"
+            self.send_json({"error": {"message": message}}, status=status, headers=headers)
+            return True
+        time.sleep(self.state.profile.delay(kind, record, self.state.fixtures))
+        return False
+
+    def send_not_found(self):
+        self.send_json({"error": {"message": "Not found: " + self.path}}, status=404)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def read_multipart(self):
+        header = "Content-Type: {}\r\n\r\n".format(self.headers["Content-Type"]).encode("utf-8")
+        message = BytesParser(policy=HTTP).parsebytes(header + self.read_body())
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = (part.get_filename(), part.get_payload(decode=True))
+        return fields
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        match = re.fullmatch(r"/v1/files/([^/]+)/content", path)
+        if match and match.group(1) in self.state.files:
+            return self.send_bytes(self.state.files[match.group(1)]["content"])
+
+        match = re.fullmatch(r"/v1/files/([^/]+)", path)
+        if match and match.group(1) in self.state.files:
+            return self.send_json(self.state.files[match.group(1)]["object"])
+
+        match = re.fullmatch(r"/v1/batches/([^/]+)", path)
+        if match and match.group(1) in self.state.batches:
+            return self.send_json(self.state.batches[match.group(1)])
+
+        self.send_not_found()
+
+    def do_PUT(self):
+        # S3 PutObject with path-style addressing: /<bucket>/<key>
+        path = self.path.split("?")[0].lstrip("/")
+        self.state.objects[path] = self.read_body()
+        self.send_response(200)
+        self.send_header("ETag", '"{}"'.format(uuid.uuid4().hex))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_DELETE(self):
+        # S3 DeleteObject
+        path = self.path.split("?")[0].lstrip("/")
+        self.state.objects.pop(path, None)
+        self.send_response(204)
+        self.end_headers()
+
+    def do_textract(self, target):
+        request = json.loads(self.read_body() or b"{}")
+        if target == "Textract.AnalyzeDocument":
+            return self.send_json({"Blocks": textract_blocks("document", n_pages=1)})
+
+        if target == "Textract.StartDocumentAnalysis":
+            job_id = self.state.start_job(request)
+            if job_id is None:
+                return self.send_json({"__type": "InvalidS3ObjectException", "message": "Unable to get object"}, status=400)
+            return self.send_json({"JobId": job_id})
+
+        if target == "Textract.GetDocumentAnalysis":
+            response = self.state.get_job(request)
+            if response is None:
+                return self.send_json({"__type": "InvalidJobIdException", "message": "Unknown job"}, status=400)
+            return self.send_json(response)
+
+        self.send_json({"__type": "UnknownOperationException"}, status=400)
+
+    def do_POST(self):
+        target = self.headers.get("X-Amz-Target")
+        if target is not None:
+            return self.do_textract(target)
+
+        path = self.path.split("?")[0].rstrip("/")
+        if path == "/v1/chat/completions":
+            body = json.loads(self.read_body())
+            record = self.state.fixtures.get("chat", chat_key(body))
+            if self.delay_or_fail("chat", record):
+                return
+            if record is None:
+                return self.send_json(chat_completion_response(body, self.state.completion(body)))
+            return self.send_json(chat_completion_response(body, record["content"], record.get("usage")))
+
+        if path == "/replay/extract":
+            # the replay provider uploads the image with the key it was
+            # recorded under
+            self.read_body()
+            record = self.state.fixtures.get("extract", self.headers.get("X-Fixture-Key"))
+            if record is None:
+                return self.send_json({"error": {"message": "No recorded response"}}, status=404)
+            if self.delay_or_fail("extract", record):
+                return
+            return self.send_json({"content": record["content"]})
+
+        if path == "/v1/files":
+            fields = self.read_multipart()
+            filename, content = fields["file"]
+            purpose = fields["purpose"][1].decode("utf-8")
+            return self.send_json(self.state.add_file(content, filename, purpose))
+
+        if path == "/v1/batches":
+            return self.send_json(self.state.create_batch(json.loads(self.read_body())))
+
+        match = re.fullmatch(r"/v1/batches/([^/]+)/cancel", path)
+        if match and match.group(1) in self.state.batches:
+            batch = self.state.batches[match.group(1)]
+            batch["status"] = "cancelled"
+            return self.send_json(batch)
+
+        self.send_not_found()
+
+
+def make_server(host="127.0.0.1", port=8000, state=None):
+    handler = type("Handler", (MockHandler,), {"state": state or MockState()})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--host", type=str, default="127.0.0.1")
+    argparser.add_argument("--port", type=int, default=8000)
+    argparser.add_argument("--batch_delay", type=float, default=1.0)
+    argparser.add_argument("--job_delay", type=float, default=2.0)
+    argparser.add_argument("--fixtures", type=str, nargs="+", default=[])
+    argparser.add_argument("--latency", type=str, default="recorded")
+    argparser.add_argument("--latency_scale", type=float, default=1.0)
+    argparser.add_argument("--error_rate", type=float, default=0.0)
+    argparser.add_argument("--throttle_rate", type=float, default=0.0)
+    argparser.add_argument("--throttle_rps", type=float, default=None)
+    argparser.add_argument("--seed", type=int, default=None)
+    args = argparser.parse_args()
+
+    fixtures = Fixtures(args.fixtures)
+    profile = LoadProfile(
+        latency=args.latency,
+        latency_scale=args.latency_scale,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        throttle_rps=args.throttle_rps,
+        seed=args.seed,
+    )
+    server = make_server(args.host, args.port, MockState(
+        batch_delay=args.batch_delay, job_delay=args.job_delay, fixtures=fixtures, profile=profile
+    ))
+    print("Mock server listening on http://{}:{} ({} recorded responses)".format(args.host, args.port, len(fixtures)))
+    server.serve_forever()
@@ -0,0 +1,169 @@
+import io
+import os
+import hashlib
+
+from concurrent.futures import ProcessPoolExecutor
+
+from cache import make_key
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff", ".gif"}
+FORMAT_EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp"}
+
+
+class PreprocessOptions:
+    def __init__(
+        self, max_side=None, max_dpi=None, image_format="keep", quality=85,
+        dedupe="exact", hash_distance=2, work_dir=".cache/preprocessed"
+    ):
+        self.max_side = max_side
+        self.max_dpi = max_dpi
+        self.image_format = image_format
+        self.quality = quality
+        self.dedupe = dedupe
+        self.hash_distance = hash_distance
+        self.work_dir = work_dir
+
+    def key(self):
+        return make_key("preprocess", self.max_side, self.max_dpi, self.image_format, self.quality)[:16]
+
+
+def difference_hash(image, size=8):
+    # 64-bit dHash: whether each pixel is brighter than its right neighbour
+    # on a small grayscale thumbnail
+    from PIL import Image
+
+    pixels = list(image.convert("L").resize((size + 1, size), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(size):
+        for column in range(size):
+            left = pixels[row * (size + 1) + column]
+            right = pixels[row * (size + 1) + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def target_scale(image, options):
+    scale = 1.0
+    if options.max_side and max(image.size) > options.max_side:
+        scale = options.max_side / max(image.size)
+    dpi = image.info.get("dpi")
+    if options.max_dpi and dpi and dpi[0] and dpi[0] > options.max_dpi:
+        scale = min(scale, options.max_dpi / float(dpi[0]))
+    return scale
+
+
+def encode(image, image_format, quality):
+    from PIL import Image
+
+    if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+        background = Image.new("RGB", image.size, "white")
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background.paste(image, mask=image.split()[-1])
+        else:
+            background.paste(image.convert("RGB"))
+        image = background
+
+    buffer = io.BytesIO()
+    if image_format == "PNG":
+        image.save(buffer, "PNG", optimize=True)
+    elif image_format == "WEBP":
+        image.save(buffer, "WEBP", quality=quality, method=4)
+    else:
+        image.save(buffer, "JPEG", quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def prepare_image(path, options):
+    # runs in a worker process; returns where the file to upload is and the
+    # hashes used to find duplicates
+    with open(path, "rb") as f:
+        data = f.read()
+    result = {
+        "path": path,
+        "prepared_path": path,
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "dhash": None,
+        "original_bytes": len(data),
+        "prepared_bytes": len(data),
+    }
+    if os.path.splitext(path)[1].lower() not in IMAGE_EXTENSIONS:
+        return result
+
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        result["dhash"] = difference_hash(image)
+
+        original_format = image.format
+        image_format = original_format if options.image_format == "keep" else options.image_format.upper()
+        if image_format not in FORMAT_EXTENSIONS:
+            image_format = "PNG"
+
+        prepared_path = os.path.join(
+            options.work_dir, options.key(), result["sha256"] + FORMAT_EXTENSIONS[image_format]
+        )
+        if os.path.exists(prepared_path):
+            result["prepared_path"] = prepared_path
+            result["prepared_bytes"] = os.path.getsize(prepared_path)
+            return result
+
+        scale = target_scale(image, options)
+        if scale < 1.0:
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image = image.resize(size, Image.LANCZOS)
+        encoded = encode(image, image_format, options.quality)
+
+    # keep the original when re-encoding does not make it smaller
+    if scale >= 1.0 and image_format == original_format and len(encoded) >= len(data):
+        return result
+
+    os.makedirs(os.path.dirname(prepared_path), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(prepared_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(encoded)
+    os.replace(tmp_path, prepared_path)
+
+    result["prepared_path"] = prepared_path
+    result["prepared_bytes"] = len(encoded)
+    return result
+
+
+def find_duplicates(prepared, options):
+    # path -> the earlier path it duplicates, by identical bytes or, with
+    # dedupe="perceptual", by dHash within hash_distance bits
+    duplicates = {}
+    by_sha256 = {}
+    hashes = []
+    for result in prepared:
+        path = result["path"]
+        if result["sha256"] in by_sha256:
+            duplicates[path] = by_sha256[result["sha256"]]
+            continue
+        by_sha256[result["sha256"]] = path
+
+        if options.dedupe == "perceptual" and result["dhash"] is not None:
+            for dhash, original in hashes:
+                if bin(dhash ^ result["dhash"]).count("1") <= options.hash_distance:
+                    duplicates[path] = original
+                    break
+            else:
+                hashes.append((result["dhash"], path))
+    return duplicates
+
+
+def preprocess_images(image_paths, options, processes=None):
+    # returns {path: path to upload} and {duplicate path: original path}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        prepared = list(executor.map(
+            prepare_image, image_paths, [options] * len(image_paths), chunksize=4
+        ))
+
+    duplicates = find_duplicates(prepared, options) if options.dedupe != "none" else {}
+    original_bytes = sum(result["original_bytes"] for result in prepared)
+    prepared_bytes = sum(result["prepared_bytes"] for result in prepared if result["path"] not in duplicates)
+    print("preprocess: {} files, {} duplicates, {:.1f} MB -> {:.1f} MB to upload".format(
+        len(prepared), len(duplicates), original_bytes / 1e6, prepared_bytes / 1e6
+    ))
+    return {result["path"]: result["prepared_path"] for result in prepared}, duplicates
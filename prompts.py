@@ -0,0 +1,137 @@
+import re
+import functools
+
+PLACEHOLDER = re.compile(r"<[A-Z]+SECTION>")
+
+# context windows in tokens; unknown models fall back to DEFAULT_CONTEXT_TOKENS
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4.1": 1047576,
+    "gpt-4.1-mini": 1047576,
+    "gpt-4.1-nano": 1047576,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4-32k": 32768,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+    "o1": 200000,
+    "o1-mini": 128000,
+    "o3": 200000,
+    "o3-mini": 200000,
+    "o4-mini": 200000,
+}
+DEFAULT_CONTEXT_TOKENS = 128000
+
+TRUNCATION_MARKER = "\n\n[... truncated ...]"
+
+
+class PromptTemplate:
+    # a template split once into static text and placeholders, so rendering
+    # is a single join and the text before the first placeholder is the
+    # same for every request
+    def __init__(self, text):
+        self.text = text
+        self.parts = []
+        position = 0
+        for match in PLACEHOLDER.finditer(text):
+            self.parts.append((False, text[position:match.start()]))
+            self.parts.append((True, match.group(0)))
+            position = match.end()
+        self.parts.append((False, text[position:]))
+
+    @property
+    def static_prefix(self):
+        return self.parts[0][1]
+
+    @property
+    def static_text(self):
+        return "".join(part for is_placeholder, part in self.parts if not is_placeholder)
+
+    def render(self, sections):
+        return "".join(
+            sections.get(part, part) if is_placeholder else part
+            for is_placeholder, part in self.parts
+        )
+
+    def __str__(self):
+        return self.text
+
+
+def compile_template(template):
+    if isinstance(template, PromptTemplate):
+        return template
+    return PromptTemplate(template)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text, model=None):
+    # exact with tiktoken, otherwise about four characters per token
+    encoding = get_encoding(model or "gpt-4o")
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def context_tokens(model, override=None):
+    if override:
+        return override
+    # the exact name, or the longest name followed by a "-" suffix such as a
+    # date, so gpt-4-0613 is gpt-4 but gpt-4.1 is not
+    for name in sorted(MODEL_CONTEXT_TOKENS, key=len, reverse=True):
+        if model == name or model.startswith(name + "-"):
+            return MODEL_CONTEXT_TOKENS[name]
+    return DEFAULT_CONTEXT_TOKENS
+
+
+def split_tokens(text, budget, model=None):
+    # split text into pieces of at most budget tokens, on line breaks where
+    # possible so markdown tables stay intact
+    pieces = []
+    piece = []
+    piece_tokens = 0
+    for line in text.splitlines(keepends=True):
+        tokens = count_tokens(line, model)
+        while tokens > budget:
+            # a single line longer than the budget is cut by characters
+            cut = max(1, len(line) * budget // tokens)
+            if piece:
+                pieces.append("".join(piece))
+                piece, piece_tokens = [], 0
+            pieces.append(line[:cut])
+            line = line[cut:]
+            tokens = count_tokens(line, model)
+        if piece and piece_tokens + tokens > budget:
+            pieces.append("".join(piece))
+            piece, piece_tokens = [], 0
+        piece.append(line)
+        piece_tokens += tokens
+    if piece or not pieces:
+        pieces.append("".join(piece))
+    return pieces
+
+
+def fit_content(content, budget, model=None, policy="truncate"):
+    # the content as a list of one or more pieces that each fit in budget
+    # tokens; "truncate" keeps the beginning, "chunk" keeps everything
+    content_tokens = count_tokens(content, model)
+    if content_tokens <= budget:
+        return [content]
+    if policy == "error":
+        raise ValueError("Content does not fit in {} tokens".format(budget))
+
+    marker_tokens = count_tokens(TRUNCATION_MARKER, model)
+    if policy == "truncate":
+        print("Warning: content of {} tokens truncated to {} tokens for {}".format(content_tokens, budget, model))
+        return [split_tokens(content, max(1, budget - marker_tokens), model)[0] + TRUNCATION_MARKER]
+    return split_tokens(content, budget, model)
@@ -0,0 +1,307 @@
+import os
+import tables
+import timing
+import textract
+
+from resilience import ProviderError
+
+LLAMAPARSE_API_KEY = ""
+OPENAI_API_KEY = ""
+UPSTAGE_API_KEY = ""
+UNSTRUCTURED_API_KEY = ""
+
+AWS_ACCESS_KEY_ID = ""
+AWS_SECRET_ACCESS_KEY = ""
+AWS_REGION = ""
+S3_BUCKET_NAME = ""
+# Optional SNS -> SQS completion notifications for Textract jobs.
+TEXTRACT_SNS_TOPIC_ARN = ""
+TEXTRACT_ROLE_ARN = ""
+TEXTRACT_SQS_QUEUE_URL = ""
+
+# Rough number of input tokens a multimodal model spends on one page image.
+IMAGE_TOKENS = 1600
+
+PROVIDERS = {}
+
+
+def register(name):
+    def decorator(cls):
+        cls.name = name
+        PROVIDERS[name] = cls
+        return cls
+    return decorator
+
+
+def get_provider(name, **http_options):
+    if name not in PROVIDERS:
+        raise ValueError("Invalid model name")
+    return PROVIDERS[name](**http_options)
+
+
+class Provider:
+    # SDKs are imported in setup() so a run only loads the backend it uses
+    name = None
+    options = {}
+    # client-side rate limits; None leaves a provider unlimited, since most
+    # quotas depend on the account's plan
+    requests_per_second = None
+    tokens_per_minute = None
+    tokens_per_page = 0
+    # longest image side the backend uses; larger images are downscaled
+    # when preprocessing is enabled
+    max_image_side = None
+
+    def __init__(self, pool_size=16, timeout=60, http2=True, endpoint_url=None):
+        self.http_options = {"pool_size": pool_size, "timeout": timeout, "http2": http2}
+        # points the provider at a local stand-in instead of the real service
+        self.endpoint_url = endpoint_url
+
+    def setup(self):
+        pass
+
+    def parse(self, image_path):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+
+class LlamaParseProvider(Provider):
+    parser_kwargs = {}
+
+    def setup(self):
+        from llama_parse import LlamaParse
+
+        self.parser = LlamaParse(api_key=LLAMAPARSE_API_KEY, **self.parser_kwargs)
+
+    def parse(self, image_path):
+        documents = self.parser.load_data(str(image_path))
+        if not documents:
+            # LlamaParse returns no documents when a job fails upstream
+            raise ProviderError("No documents returned for {}".format(image_path), retryable=True)
+        return documents[0].text
+
+
+@register("llamaparse")
+class LlamaParseMarkdownProvider(LlamaParseProvider):
+    options = {"result_type": "markdown", "premium_mode": True}
+    parser_kwargs = {
+        "result_type": "markdown",
+        "premium_mode": True,  # "markdown" and "text" are available
+    }
+
+
+@register("sonnet")
+class SonnetProvider(LlamaParseProvider):
+    options = {"result_type": "markdown", "vendor_multimodal_model_name": "anthropic-sonnet-3.5"}
+    tokens_per_page = IMAGE_TOKENS
+    max_image_side = 1568
+    parser_kwargs = {
+        "result_type": "markdown",  # "markdown" and "text" are available
+        "use_vendor_multimodal_model": True,
+        "vendor_multimodal_model_name": "anthropic-sonnet-3.5",
+    }
+
+
+@register("gpt4o")
+class GPT4oProvider(LlamaParseProvider):
+    options = {"result_type": "markdown", "vendor_multimodal_model": "openai-gpt4o"}
+    tokens_per_page = IMAGE_TOKENS
+    max_image_side = 2048
+    parser_kwargs = {
+        "result_type": "markdown",  # "markdown" and "text" are available
+        "use_vendor_multimodal_model": True,
+        "vendor_multimodal_model": "openai-gpt4o",
+        "gpt4o_api_key": OPENAI_API_KEY,
+    }
+
+
+@register("replay")
+class ReplayProvider(Provider):
+    # replays the responses of another provider recorded with
+    # extract_contents.py --record_fixtures, served by mock_server.py --fixtures;
+    # the image is still uploaded so transfer time is part of the benchmark
+    endpoint = "http://127.0.0.1:8000"
+
+    def __init__(self, replay_provider="upstage", **http_options):
+        super().__init__(**http_options)
+        self.recorded = PROVIDERS[replay_provider]
+        self.options = {"provider": replay_provider}
+        self.tokens_per_page = self.recorded.tokens_per_page
+        self.max_image_side = self.recorded.max_image_side
+
+    def setup(self):
+        from http_client import HttpClient
+
+        self.http = HttpClient(**self.http_options)
+        self.url = (self.endpoint_url or self.endpoint).rstrip("/") + "/replay/extract"
+
+    def parse(self, image_path):
+        from cache import make_key
+
+        with open(image_path, "rb") as f:
+            data = f.read()
+        # the key extract_contents.py recorded the response under
+        key = make_key("extract", self.recorded.name, self.recorded.options, data)
+        response = self.http.post(
+            self.url,
+            headers={"X-Fixture-Key": key},
+            files={"document": (os.path.basename(image_path), data)},
+        )
+        response.raise_for_status()
+        return response.json()["content"]
+
+    def teardown(self):
+        self.http.close()
+
+
+@register("upstage")
+class UpstageProvider(Provider):
+    endpoint = "https://api.upstage.ai/v1/document-ai/document-parse"
+    options = {
+        "ocr": "force",
+        "model": "document-parse-240910",
+        "output_formats": "{}".format(["text", "html", "markdown"])
+    }
+
+    def setup(self):
+        from http_client import HttpClient
+
+        self.http = HttpClient(**self.http_options)
+        if self.endpoint_url:
+            self.endpoint = self.endpoint_url
+        self.headers = {
+            "Authorization": f"Bearer {UPSTAGE_API_KEY}",
+        }
+
+    def parse(self, image_path):
+        with open(image_path, "rb") as f:
+            files = {
+                "document": (os.path.basename(image_path), f),
+            }
+
+            response = self.http.post(
+                self.endpoint,
+                headers=self.headers,
+                files=files,
+                data=self.options
+            )
+        response.raise_for_status()
+        json_result = response.json()
+        if "content" not in json_result:
+            raise ProviderError(
+                "Unexpected response for {}: {}".format(image_path, json_result),
+                status_code=response.status_code
+            )
+        return json_result["content"]["markdown"]
+
+    def teardown(self):
+        self.http.close()
+
+
+@register("unstructured")
+class UnstructuredProvider(Provider):
+    options = {"strategy": "hi_res", "pdf_infer_table_structure": True, "languages": ["eng", "kor"]}
+
+    def setup(self):
+        import unstructured_client
+        from unstructured_client.models import operations, shared
+
+        self.operations = operations
+        self.shared = shared
+        self.client = unstructured_client.UnstructuredClient(
+            api_key_auth=UNSTRUCTURED_API_KEY,
+            server_url="https://api.unstructuredapp.io/general/v0/general",
+        )
+
+    def parse(self, image_path):
+        operations, shared = self.operations, self.shared
+        with open(image_path, "rb") as f:
+            data = f.read()
+
+        req = operations.PartitionRequest(
+            partition_parameters=shared.PartitionParameters(
+                files=shared.Files(
+                    content=data,
+                    file_name=str(image_path),
+                ),
+                # --- Other partition parameters ---
+                strategy=shared.Strategy.HI_RES,
+                pdf_infer_table_structure=True,
+                coordinates=True,
+                languages=["eng", "kor"],
+            ),
+        )
+
+        res = self.client.general.partition(request=req)
+        elements = res.elements
+        texts = []
+        for elem in elements:
+            html = elem.get("metadata", {}).get("text_as_html")
+            if elem.get("type") == "Table" and html:
+                # keep the table structure instead of its flattened text
+                texts.append(tables.html_to_markdown(html) + "\n")
+            else:
+                texts.append(elem["text"] + "\n")
+
+        return "".join(texts)
+
+
+@register("aws")
+class AWSProvider(Provider):
+    options = {"feature_types": ["LAYOUT", "TABLES"]}
+    # the default AnalyzeDocument quota in the largest regions; many regions
+    # allow fewer, so lower it with --requests_per_second there
+    requests_per_second = 10
+    s3_bucket_name = S3_BUCKET_NAME
+
+    def setup(self):
+        import boto3
+        from botocore.config import Config
+
+        from textract_jobs import SQSNotifier, TextractJobRunner
+
+        session = boto3.session.Session(
+            region_name=AWS_REGION,
+            aws_access_key_id=AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+        )
+        config = Config(
+            max_pool_connections=self.http_options["pool_size"],
+            s3={"addressing_style": "path"} if self.endpoint_url else None,
+        )
+        self.s3 = session.resource("s3", endpoint_url=self.endpoint_url, config=config)
+        self.client = session.client("textract", endpoint_url=self.endpoint_url, config=config)
+
+        notifier = None
+        if TEXTRACT_SQS_QUEUE_URL:
+            notifier = SQSNotifier(
+                session.client("sqs", endpoint_url=self.endpoint_url),
+                TEXTRACT_SQS_QUEUE_URL, TEXTRACT_SNS_TOPIC_ARN, TEXTRACT_ROLE_ARN
+            )
+        self.jobs = TextractJobRunner(
+            self.client, self.s3, self.s3_bucket_name,
+            self.options["feature_types"], notifier=notifier
+        )
+
+    def parse(self, image_path):
+        if str(image_path).lower().endswith(".pdf"):
+            # multi-page documents need the asynchronous S3 job API
+            result = self.jobs.analyze(image_path)
+        else:
+            with open(image_path, "rb") as file:
+                img_test = file.read()
+                bytes_test = bytearray(img_test)
+
+            result = self.client.analyze_document(
+                Document={"Bytes": bytes_test},
+                FeatureTypes=self.options["feature_types"]
+            )
+
+        with timing.phase("postprocess"):
+            processed_list = textract.post_process(result)
+            return textract.to_text(processed_list, tables.html_to_markdown)
+
+    def teardown(self):
+        self.jobs.close()
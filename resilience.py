@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import random
+import threading
+import contextvars
+
+from email.utils import parsedate_to_datetime
+
+import timing
+from utils import atomic_write
+
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+RETRYABLE_AWS_ERRORS = {
+    "ThrottlingException",
+    "ProvisionedThroughputExceededException",
+    "LimitExceededException",
+    "InternalServerError",
+    "ServiceUnavailableException",
+}
+
+# set by the engine to a function called with (latency, exc) after every attempt
+call_observer = contextvars.ContextVar("call_observer", default=None)
+
+
+class ProviderError(Exception):
+    def __init__(self, message, retryable=False, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def get_status_code(exc):
+    status_code = getattr(exc, "status_code", None)
+    if status_code is not None:
+        return status_code
+
+    response = getattr(exc, "response", None)
+    if isinstance(response, dict):
+        # botocore ClientError
+        return response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return getattr(response, "status_code", None)
+
+
+def get_retry_after(exc):
+    retry_after = getattr(exc, "retry_after", None)
+    if retry_after is not None:
+        return retry_after
+
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def is_retryable(exc):
+    if isinstance(exc, ProviderError):
+        return exc.retryable or exc.status_code in RETRYABLE_STATUS_CODES
+
+    response = getattr(exc, "response", None)
+    if isinstance(response, dict):
+        if response.get("Error", {}).get("Code") in RETRYABLE_AWS_ERRORS:
+            return True
+
+    status_code = get_status_code(exc)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    # SDK-specific network errors (openai.APIConnectionError, httpx.ConnectError,
+    # requests.ConnectionError, botocore EndpointConnectionError, ...)
+    name = type(exc).__name__
+    return "Timeout" in name or "Connect" in name
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, exc=None):
+        # full jitter, but never sooner than the server asked for
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = get_retry_after(exc) if exc is not None else None
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+class CircuitBreaker:
+    # opens after failure_threshold consecutive failures; while open, callers
+    # wait for reset_timeout and then a single probe call is let through
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def wait(self):
+        while True:
+            with self._lock:
+                state = self.state
+                if state == "closed":
+                    return False
+                if state == "half-open" and not self.probing:
+                    self.probing = True
+                    return True
+                remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            time.sleep(max(remaining, 0.1))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def end_probe(self):
+        # a probe that ended without a verdict (e.g. a 400) lets the next caller probe
+        with self._lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.probing:
+                    print("Circuit opened after {} failures".format(self.failures))
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+
+def call_with_retry(fn, *args, policy=None, breaker=None, **kwargs):
+    policy = policy or RetryPolicy()
+    for attempt in range(policy.max_attempts):
+        probe = breaker.wait() if breaker is not None else False
+        observer = call_observer.get()
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as exc:
+            if observer is not None:
+                observer(time.perf_counter() - start, exc)
+            retryable = is_retryable(exc)
+            if breaker is not None and retryable:
+                breaker.record_failure()
+                probe = False
+            if not retryable or attempt + 1 == policy.max_attempts:
+                raise
+            delay = policy.delay(attempt, exc)
+            timing.add_count("retries")
+            with timing.phase("backoff"):
+                time.sleep(delay)
+        else:
+            if observer is not None:
+                observer(time.perf_counter() - start)
+            if breaker is not None:
+                breaker.record_success()
+                probe = False
+            return result
+        finally:
+            if probe:
+                breaker.end_probe()
+
+
+class DeadLetterQueue:
+    def __init__(self, path):
+        self.path = path
+        self.replay_offset = 0
+        self._lock = threading.Lock()
+
+    def add(self, item, exc):
+        entry = {
+            "item": item,
+            "error_type": type(exc).__name__,
+            "error": str(exc),
+            "status_code": get_status_code(exc),
+            "time": time.time(),
+        }
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        print("Failed {}: {}: {}".format(item, entry["error_type"], entry["error"]))
+
+    def items(self):
+        # during a replay, only the failures recorded since take()
+        if not os.path.exists(self.path):
+            return []
+        items = {}
+        with open(self.path, "rb") as f:
+            f.seek(self.replay_offset)
+            for line in f:
+                try:
+                    items[json.loads(line)["item"]] = True
+                except (json.JSONDecodeError, KeyError):
+                    continue
+        return list(items)
+
+    def take(self):
+        # items to replay; they stay in the file until finish_replay(), so an
+        # interrupted replay loses nothing, and failures during the replay
+        # are recorded again after them
+        with self._lock:
+            items = self.items()
+            if os.path.exists(self.path):
+                self.replay_offset = os.path.getsize(self.path)
+        return items
+
+    def finish_replay(self):
+        # rewrite the file with only the items that failed again
+        with self._lock:
+            if not self.replay_offset or not os.path.exists(self.path):
+                return
+            with open(self.path, "rb") as f:
+                f.seek(self.replay_offset)
+                failed = f.read().decode("utf-8")
+            atomic_write(self.path, failed)
+            self.replay_offset = 0
+
+    def __len__(self):
+        return len(self.items())
+
+
+def dead_letter_on_failure(fn, dead_letters, item=lambda arg: arg):
+    # run fn for one work item; a failure is recorded and becomes None so the
+    # rest of the run continues, and None inputs from an earlier stage pass through
+    def wrapper(arg, **kwargs):
+        if arg is None:
+            return None
+        try:
+            return fn(arg, **kwargs)
+        except Exception as exc:
+            dead_letters.add(item(arg), exc)
+            return None
+    return wrapper
+
+
+def open_dead_letters(save_dir):
+    os.makedirs(save_dir, exist_ok=True)
+    return DeadLetterQueue(os.path.join(save_dir, "dead_letters.jsonl"))
@@ -0,0 +1,193 @@
+import os
+import json
+import argparse
+import tempfile
+import threading
+
+from utils import atomic_write
+
+
+class ResultStore:
+    # append-only JSON lines store for extracted contents, prompts, answers
+    # and scores; each record has a "kind" and an "item", and a later record
+    # for the same kind and item replaces an earlier one
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+    def append(self, kind, item, **fields):
+        record = {"kind": kind, "item": item}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+        return self.path
+
+    def records(self, kind=None):
+        # streams records back without loading the whole store
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a run killed mid-append leaves a partial last line
+                    continue
+                if kind is None or record.get("kind") == kind:
+                    yield record
+
+    def index(self, kind):
+        # item -> byte offset of its latest record, for random access
+        # without keeping the contents in memory
+        offsets = {}
+        if not os.path.exists(self.path):
+            return offsets
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    record = None
+                if record is not None and record.get("kind") == kind:
+                    offsets[record["item"]] = offset
+                offset += len(line)
+        return offsets
+
+    def read_at(self, offset):
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class StoreContents:
+    # extracted contents read back from a store by item
+    def __init__(self, store, kind="content"):
+        self.store = store
+        self.offsets = store.index(kind)
+
+    def items(self):
+        return list(self.offsets)
+
+    def read(self, item):
+        return self.store.read_at(self.offsets[item])["content"]
+
+
+class DirectoryOutput:
+    # the default layout: one directory per document with one file per kind
+    filenames = {"prompt": "prompt.txt", "scores": "scores.txt"}
+
+    def __init__(self, save_basepath):
+        self.save_basepath = save_basepath
+
+    def write(self, item, kind, content, **fields):
+        if kind not in self.filenames:
+            return None
+        save_dir = os.path.join(self.save_basepath, item)
+        os.makedirs(save_dir, exist_ok=True)
+        save_path = os.path.join(save_dir, self.filenames[kind])
+        atomic_write(save_path, content)
+        return save_path
+
+
+class StoreOutput:
+    def __init__(self, store):
+        self.store = store
+
+    def write(self, item, kind, content, **fields):
+        return self.store.append(kind, item, content=content, **fields)
+
+
+def merge_stores(path, shard_paths):
+    # concatenates the stores written by --shard runs into path, replacing
+    # it; partial last lines of killed runs are dropped
+    shard_paths = [shard_path for shard_path in shard_paths if os.path.exists(shard_path)]
+    if not shard_paths:
+        return 0
+    dirname = os.path.dirname(path) or "."
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+    records = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for shard_path in shard_paths:
+                with open(shard_path, "rb") as f:
+                    for line in f:
+                        if line.endswith(b"\n"):
+                            out.write(line)
+                            records += 1
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return records
+
+
+def is_store_path(path):
+    return os.path.isfile(path) and path.endswith(".jsonl")
+
+
+def write_parquet(store, path, kind, batch_size=10000):
+    # converts one kind of record to Parquet in batches, so the store is
+    # never loaded at once
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    batch = []
+    try:
+        for record in store.records(kind):
+            batch.append(record)
+            if len(batch) == batch_size:
+                writer = write_parquet_batch(pa, pq, writer, path, batch)
+                batch = []
+        if batch:
+            writer = write_parquet_batch(pa, pq, writer, path, batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def write_parquet_batch(pa, pq, writer, path, batch):
+    for record in batch:
+        for key, value in record.items():
+            if isinstance(value, (list, dict)):
+                record[key] = json.dumps(value, ensure_ascii=False)
+
+    if writer is None:
+        table = pa.Table.from_pylist(batch)
+        writer = pq.ParquetWriter(path, table.schema)
+    else:
+        table = pa.Table.from_pylist(batch, schema=writer.schema)
+    writer.write_table(table)
+    return writer
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("store_path", type=str)
+    argparser.add_argument("--kind", type=str, default="content")
+    argparser.add_argument("--parquet", type=str, default=None)
+    args = argparser.parse_args()
+
+    store = ResultStore(args.store_path)
+    if args.parquet:
+        write_parquet(store, args.parquet, args.kind)
+    else:
+        for record in store.records(args.kind):
+            print(json.dumps(record, ensure_ascii=False))
@@ -0,0 +1,150 @@
+import re
+import math
+
+from collections import Counter
+
+from prompts import count_tokens, split_tokens
+
+HEADING = re.compile(r"^#{1,6}\s")
+TOKEN = re.compile(r"\w+")
+
+
+def markdown_blocks(content):
+    # (heading, block) pairs: markdown tables and HTML tables are kept whole,
+    # other text is split on blank lines; heading is the section's title
+    blocks = []
+    heading = ""
+    lines = []
+    kind = None
+
+    def flush():
+        if lines and "".join(lines).strip():
+            blocks.append((heading, "".join(lines).strip("\n")))
+        lines.clear()
+
+    for line in content.splitlines(keepends=True):
+        stripped = line.strip()
+        if kind == "html":
+            lines.append(line)
+            if "</table>" in stripped.lower():
+                flush()
+                kind = None
+            continue
+
+        if HEADING.match(stripped):
+            flush()
+            heading = stripped
+            kind = None
+            continue
+        if stripped.lower().startswith("<table"):
+            flush()
+            lines.append(line)
+            kind = "html"
+            if "</table>" in stripped.lower():
+                flush()
+                kind = None
+            continue
+
+        line_kind = "table" if stripped.startswith("|") else "text"
+        if not stripped or line_kind != kind:
+            flush()
+        kind = line_kind if stripped else None
+        if stripped:
+            lines.append(line)
+    flush()
+    return blocks
+
+
+def chunk_markdown(content, chunk_tokens=512, model=None):
+    # chunks of at most about chunk_tokens tokens along the document's
+    # structure; each chunk starts with its section heading
+    chunks = []
+    chunk = []
+    chunk_heading = None
+    size = 0
+    for heading, block in markdown_blocks(content):
+        tokens = count_tokens(block, model)
+        if chunk and (heading != chunk_heading or size + tokens > chunk_tokens):
+            chunks.append(chunk_text(chunk_heading, chunk))
+            chunk, size = [], 0
+        chunk_heading = heading
+        if tokens > chunk_tokens:
+            # a single block larger than a chunk, e.g. a long table
+            chunks.extend(chunk_text(heading, [piece]) for piece in split_tokens(block, chunk_tokens, model))
+            continue
+        chunk.append(block)
+        size += tokens
+    if chunk:
+        chunks.append(chunk_text(chunk_heading, chunk))
+    return chunks
+
+
+def chunk_text(heading, blocks):
+    text = "\n\n".join(blocks)
+    if heading and not text.startswith(heading):
+        text = heading + "\n\n" + text
+    return text
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+class BM25Index:
+    # Okapi BM25 over the chunks of one document, built in memory per request
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.term_counts = [Counter(tokenize(chunk)) for chunk in chunks]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self.average_length = sum(self.lengths) / len(chunks) if chunks else 0.0
+        document_frequency = Counter(term for counts in self.term_counts for term in counts)
+        self.idf = {
+            term: math.log(1 + (len(chunks) - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+
+    def scores(self, query):
+        terms = [term for term in tokenize(query) if term in self.idf]
+        scores = []
+        for counts, length in zip(self.term_counts, self.lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / (self.average_length or 1.0))
+            scores.append(sum(
+                self.idf[term] * counts[term] * (self.k1 + 1) / (counts[term] + norm)
+                for term in terms if term in counts
+            ))
+        return scores
+
+    def search(self, query, top_k):
+        scores = self.scores(query)
+        ranked = sorted(range(len(scores)), key=lambda idx: (-scores[idx], idx))
+        return [idx for idx in ranked[:top_k] if scores[idx] > 0]
+
+
+class RetrievalOptions:
+    def __init__(self, top_k=3, chunk_tokens=512):
+        self.top_k = top_k
+        self.chunk_tokens = chunk_tokens
+
+    def key(self):
+        return ["retrieval", self.top_k, self.chunk_tokens]
+
+    def select(self, content, questions, model=None):
+        return retrieve_content(content, questions, self.top_k, self.chunk_tokens, model)
+
+
+def retrieve_content(content, questions, top_k=3, chunk_tokens=512, model=None):
+    # the top_k chunks for each question, in document order; falls back to
+    # the first chunk when no question matches anything
+    chunks = chunk_markdown(content, chunk_tokens, model)
+    if len(chunks) <= top_k:
+        return content
+
+    index = BM25Index(chunks)
+    selected = set()
+    for question in questions:
+        selected.update(index.search(question["question"], top_k))
+    if not selected:
+        selected.add(0)
+    return "\n\n".join(chunks[idx] for idx in sorted(selected))
@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import argparse
+import functools
+
+import timing
+import run_qa_eval
+from aggregate import BreakdownWriter, ScoreAggregator
+from cache import make_key, open_cache, print_stats
+from engine import RateLimiter, run
+from extract_contents import run_extraction
+from local_scorer import ScoringReport
+from manifest import open_manifest
+from prompts import PromptTemplate, context_tokens
+from providers import PROVIDERS, get_provider
+from resilience import CircuitBreaker, RetryPolicy, dead_letter_on_failure, open_dead_letters
+from result_store import DirectoryOutput
+from utils import atomic_write, get_content_path_list
+
+# list prices in USD; per page for parsers and per million tokens for
+# models; override with --prices
+DEFAULT_PRICES = {
+    "parsers": {
+        "llamaparse": 0.003,
+        "upstage": 0.01,
+        "aws": 0.019,
+    },
+    "models": {
+        "gpt-4o": {"prompt": 2.5, "completion": 10.0},
+        "gpt-4o-mini": {"prompt": 0.15, "completion": 0.6},
+    },
+}
+
+COLUMNS = [
+    ("parser", "{}"),
+    ("answering_model", "{}"),
+    ("evaluate_model", "{}"),
+    ("documents", "{}"),
+    ("questions", "{}"),
+    ("accuracy", "{:.4f}"),
+    ("extract_p50", "{:.3f}"),
+    ("extract_p95", "{:.3f}"),
+    ("answer_p50", "{:.3f}"),
+    ("evaluate_p50", "{:.3f}"),
+    ("cost_usd", "{:.4f}"),
+]
+
+
+def load_prices(path):
+    prices = json.loads(json.dumps(DEFAULT_PRICES))
+    if path:
+        with open(path, "r") as f:
+            overrides = json.load(f)
+        for section in ("parsers", "models"):
+            prices[section].update(overrides.get(section, {}))
+    return prices
+
+
+def model_cost(records, model, prices):
+    # cost of every request, including the ones served from the cache
+    price = prices["models"].get(model)
+    if price is None:
+        return None
+    prompt_tokens = sum(record.get("prompt_tokens", 0) + record.get("cached_prompt_tokens", 0) for record in records)
+    completion_tokens = sum(
+        record.get("completion_tokens", 0) + record.get("cached_completion_tokens", 0) for record in records
+    )
+    return (prompt_tokens * price["prompt"] + completion_tokens * price["completion"]) / 1e6
+
+
+def latency(records, q):
+    return timing.percentile([record["latency"] for record in records if record["status"] == "ok"], q)
+
+
+def extract_parser(parser, args, cache):
+    save_dir = os.path.join(args.save_basepath, "extract", parser)
+    provider = get_provider(parser, pool_size=args.parser_concurrency)
+    timing_log = timing.open_timing_log(save_dir)
+    run_extraction(
+        args.image_dir, save_dir, provider,
+        concurrency=args.parser_concurrency,
+        rate_limiter=RateLimiter(provider.requests_per_second, provider.tokens_per_minute),
+        cache=cache,
+        manifest=open_manifest(save_dir, rerun=args.rerun),
+        policy=RetryPolicy(max_attempts=args.max_attempts),
+        breaker=CircuitBreaker(),
+        dead_letters=open_dead_letters(save_dir),
+        timing_log=timing_log,
+    )
+    file_paths = get_content_path_list(save_dir)
+    return file_paths, timing_log.records(run=timing_log.run)
+
+
+def answer_documents(file_paths, parser, answering_model, templates, args, cache):
+    # answers are shared by every judge of this parser and answering model
+    save_dir = os.path.join(args.save_basepath, "qa", parser, answering_model)
+    input_key = [templates["question"].text, answering_model, args.overflow_policy]
+    answer_stage = dead_letter_on_failure(functools.partial(
+        run_qa_eval.answer_document,
+        question_template=templates["question"],
+        question_basepath=args.question_basepath,
+        answering_model=answering_model,
+        save_basepath=save_dir,
+        cache=cache,
+        input_key=input_key,
+        max_prompt_tokens=context_tokens(answering_model) - args.max_completion_tokens,
+        overflow_policy=args.overflow_policy,
+    ), open_dead_letters(save_dir))
+    documents = run(
+        file_paths, answer_stage,
+        concurrency=args.answer_concurrency, desc="Answering {} / {}".format(parser, answering_model)
+    )
+    return [document for document in documents if document is not None]
+
+
+def evaluate_documents(documents, parser, answering_model, evaluate_model, templates, args, cache):
+    save_dir = os.path.join(args.save_basepath, "qa", parser, answering_model, "judge_" + evaluate_model)
+    manifest = open_manifest(save_dir, rerun=args.rerun)
+    report = ScoringReport() if args.local_scoring else None
+
+    def evaluate(document):
+        # each judge scores its own copy of the shared answers
+        document = dict(document)
+        document["output"] = DirectoryOutput(save_dir)
+        document["input_hash"] = make_key("judge", document["input_hash"], templates["evaluate"].text, evaluate_model)
+        entry = manifest.get(document["basename"], document["input_hash"])
+        if entry is not None:
+            return entry["scores"]
+        return run_qa_eval.evaluate_document(
+            document, templates["evaluate"], evaluate_model,
+            cache=cache, manifest=manifest, report=report
+        )
+
+    evaluate_stage = dead_letter_on_failure(
+        evaluate, open_dead_letters(save_dir), item=lambda document: document["file_path"]
+    )
+    results = run(
+        documents, evaluate_stage,
+        concurrency=args.evaluate_concurrency,
+        desc="Evaluating {} / {} / {}".format(parser, answering_model, evaluate_model)
+    )
+    scores = [score for result in results if result is not None for score in result]
+    run_qa_eval.write_final_score(save_dir, scores)
+
+    aggregator = ScoreAggregator(parser=parser)
+    for document, result in zip(documents, results):
+        if result is not None:
+            aggregator.add(document["basename"], json.loads(document["question"]), result)
+    BreakdownWriter(
+        aggregator,
+        os.path.join(save_dir, "score_breakdown.json"),
+        os.path.join(save_dir, "score_breakdown.txt"),
+    ).write(force=True)
+    return len([result for result in results if result is not None]), scores
+
+
+def run_parser(parser, args, templates, cache, prices):
+    try:
+        return run_parser_cells(parser, args, templates, cache, prices)
+    except Exception as exc:
+        # one broken parser should not take down the rest of the matrix
+        print("Parser {} failed: {}: {}".format(parser, type(exc).__name__, exc))
+        return []
+
+
+def run_parser_cells(parser, args, templates, cache, prices):
+    with timing.labels(parser=parser):
+        file_paths, extract_records = extract_parser(parser, args, cache)
+
+        def run_answering_model(answering_model):
+            with timing.labels(answering_model=answering_model):
+                documents = answer_documents(file_paths, parser, answering_model, templates, args, cache)
+                return run(
+                    args.evaluate_models,
+                    functools.partial(
+                        evaluate_documents, documents, parser, answering_model,
+                        templates=templates, args=args, cache=cache
+                    ),
+                    concurrency=len(args.evaluate_models)
+                )
+
+        results = run(args.answering_models, run_answering_model, concurrency=len(args.answering_models))
+
+    parser_price = prices["parsers"].get(parser)
+    pages = len(file_paths)
+    cells = []
+    for answering_model, judge_results in zip(args.answering_models, results):
+        for evaluate_model, (documents, scores) in zip(args.evaluate_models, judge_results):
+            cells.append({
+                "parser": parser,
+                "answering_model": answering_model,
+                "evaluate_model": evaluate_model,
+                "documents": documents,
+                "questions": len(scores),
+                "accuracy": sum(scores) / len(scores) if scores else None,
+                "extract_p50": latency(extract_records, 50),
+                "extract_p95": latency(extract_records, 95),
+                "extract_cost": parser_price * pages if parser_price is not None else None,
+            })
+    return cells
+
+
+def add_model_costs(cells, records, prices):
+    # answer costs are shared by the judges of a parser and answering model,
+    # but each cell reports the full cost of producing its scores
+    for cell in cells:
+        answer_records = [
+            record for record in records
+            if record["kind"] == "answer"
+            and record.get("parser") == cell["parser"]
+            and record.get("answering_model") == cell["answering_model"]
+        ]
+        evaluate_records = [
+            record for record in records
+            if record["kind"] == "evaluate"
+            and record.get("parser") == cell["parser"]
+            and record.get("answering_model") == cell["answering_model"]
+            and record.get("model") == cell["evaluate_model"]
+        ]
+        cell["answer_p50"] = latency(answer_records, 50)
+        cell["evaluate_p50"] = latency(evaluate_records, 50)
+
+        costs = [
+            cell.pop("extract_cost"),
+            model_cost(answer_records, cell["answering_model"], prices),
+            model_cost(evaluate_records, cell["evaluate_model"], prices),
+        ]
+        cell["cost_usd"] = sum(costs) if None not in costs else None
+
+
+def format_table(cells):
+    rows = [[name for name, _ in COLUMNS]]
+    for cell in cells:
+        rows.append([
+            "-" if cell.get(name) is None else spec.format(cell[name])
+            for name, spec in COLUMNS
+        ])
+
+    widths = [max(len(row[idx]) for row in rows) for idx in range(len(COLUMNS))]
+    lines = []
+    for row_idx, row in enumerate(rows):
+        lines.append("| " + " | ".join(value.ljust(width) for value, width in zip(row, widths)) + " |")
+        if row_idx == 0:
+            lines.append("|" + "|".join("-" * (width + 2) for width in widths) + "|")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--image_dir", type=str, required=True)
+    argparser.add_argument("--parsers", type=str, nargs="+", required=True, choices=sorted(PROVIDERS))
+    argparser.add_argument("--answering_models", type=str, nargs="+", default=["gpt-4o"])
+    argparser.add_argument("--evaluate_models", type=str, nargs="+", default=["gpt-4o"])
+    argparser.add_argument("--save_basepath", type=str, default="results/matrix")
+    argparser.add_argument("--question_basepath", type=str, default="dataset/questions")
+    argparser.add_argument("--question_template_path", type=str, default="dataset/templates/question_template.txt")
+    argparser.add_argument("--evaluate_template_path", type=str, default="dataset/templates/evaluate_template.txt")
+    argparser.add_argument("--parser_concurrency", type=int, default=8)
+    argparser.add_argument("--answer_concurrency", type=int, default=8)
+    argparser.add_argument("--evaluate_concurrency", type=int, default=8)
+    argparser.add_argument("--cache_path", type=str, default=".cache/responses.sqlite")
+    argparser.add_argument("--cache_max_mb", type=float, default=1024)
+    argparser.add_argument("--rerun", action="store_true")
+    argparser.add_argument("--local_scoring", action="store_true")
+    argparser.add_argument("--max_completion_tokens", type=int, default=4096)
+    argparser.add_argument("--overflow_policy", type=str, default="truncate", choices=["truncate", "chunk", "error"])
+    argparser.add_argument("--max_attempts", type=int, default=5)
+    argparser.add_argument("--openai_base_url", type=str, default=None)
+    argparser.add_argument("--prices", type=str, default=None)
+    args = argparser.parse_args()
+
+    run_qa_eval.OPENAI_RETRY_POLICY.max_attempts = args.max_attempts
+    if args.openai_base_url:
+        run_qa_eval.openai.base_url = args.openai_base_url
+    os.makedirs(args.save_basepath, exist_ok=True)
+    qa_timing_log = timing.open_timing_log(args.save_basepath, rerun=args.rerun)
+    run_qa_eval.OPENAI_TIMING_LOG = qa_timing_log
+
+    cache = open_cache(args.cache_path, args.cache_max_mb)
+    prices = load_prices(args.prices)
+    with open(args.question_template_path, "r") as f:
+        question_template = PromptTemplate(f.read())
+    with open(args.evaluate_template_path, "r") as f:
+        evaluate_template = PromptTemplate(f.read())
+    templates = {"question": question_template, "evaluate": evaluate_template}
+
+    # every parser runs concurrently; within a parser, extraction is shared
+    # by all answering models and each model's answers by all judges
+    start_time = time.time()
+    parser_cells = run(
+        args.parsers,
+        functools.partial(run_parser, args=args, templates=templates, cache=cache, prices=prices),
+        concurrency=len(args.parsers), desc="Parsers"
+    )
+    cells = [cell for result in parser_cells for cell in result]
+    add_model_costs(cells, qa_timing_log.records(run=qa_timing_log.run), prices)
+
+    table = format_table(cells)
+    atomic_write(os.path.join(args.save_basepath, "matrix.md"), table + "\n")
+    atomic_write(os.path.join(args.save_basepath, "matrix.json"), json.dumps(cells, indent=2))
+    print(table)
+    print("time: ", time.time() - start_time)
+    print_stats(cache)
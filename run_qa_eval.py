@@ -1,35 +1,207 @@
 import os
 import json
 import openai
+import random
 import argparse
+import functools
+import threading
 
-from glob import glob
+import timing
+import distributed
+from aggregate import BreakdownWriter, ScoreAggregator, format_breakdown
+from cache import make_key, open_cache, print_stats
+from batch_api import run_batch
+from engine import AdaptiveConcurrency, run, run_stages
+from local_scorer import ScoringReport, merge_scores, score_locally
+from fixtures import open_recorder, timed_call
+from manifest import open_manifest
+from prompts import PromptTemplate, compile_template, context_tokens, count_tokens, fit_content
+from resilience import CircuitBreaker, RetryPolicy, call_with_retry, dead_letter_on_failure, open_dead_letters
+from retrieval import RetrievalOptions
+from result_store import DirectoryOutput, ResultStore, StoreContents, StoreOutput, is_store_path, merge_stores
+from structured_output import (
+    ANSWER_SCHEMA, SCORES_SCHEMA, MalformedResponse, find_json_array, parse_answers, parse_scores, validate_scores
+)
+from utils import (
+    atomic_write, document_basename, duplicate_basenames, get_content_path_list, in_shard, parse_shard, question_index, shard_dir, shard_path
+)
 
-OPENAI_API_KEY = ""
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")
 
+OPENAI_RETRY_POLICY = RetryPolicy()
+OPENAI_CIRCUIT_BREAKER = CircuitBreaker()
+OPENAI_TIMING_LOG = None
+# set with --record_fixtures to record responses for mock_server.py --fixtures
+OPENAI_FIXTURES = None
+# answers and scores are requested as JSON matching a schema; turn off with
+# --no_structured_output for models without response_format support
+STRUCTURED_OUTPUT = True
+# how often a malformed answer or score list is asked for again
+MALFORMED_REASKS = 2
+REASK_NOTE = "\n\n# Note:\nYour previous response could not be used: {}. Respond with the JSON only."
 
-def ask_question(prompt, model):
-    openai.api_key = OPENAI_API_KEY
-    response = openai.chat.completions.create(
-        model=model,
-        messages=[
+BATCH_EVAL_SCHEMA = {
+    "name": "batch_scores",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "documents": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "string"},
+                        "scores": {"type": "array", "items": {"type": "integer", "enum": [0, 1]}},
+                    },
+                    "required": ["id", "scores"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["documents"],
+        "additionalProperties": False,
+    },
+}
+
+
+ANSWER_SYSTEM_PROMPT = "You are a helpful AI assistant that answers questions given the content within the document."
+EVALUATE_SYSTEM_PROMPT = "You are a helpful AI assistant that evaluates list of model answers given the reference answer."
+BATCH_EVALUATE_SYSTEM_PROMPT = "You are a helpful AI assistant that evaluates lists of model answers given the reference answers."
+
+
+def chat_request(system_prompt, prompt, model, response_format=None):
+    body = {
+        "model": model,
+        "messages": [
             {
                 "role": "system",
-                "content": "You are a helpful AI assistant that answers questions given the content within the document."
+                "content": system_prompt
             },
             {
                 "role": "user", "content": prompt
             }
         ]
+    }
+    if response_format is not None:
+        body["response_format"] = response_format
+    return body
+
+
+def chat_cache_key(system_prompt, prompt, model, response_format=None):
+    return make_key("chat", model, system_prompt, prompt, response_format)
+
+
+def chat_completion(system_prompt, prompt, model, cache=None, response_format=None, kind="chat", parse=None):
+    def create():
+        openai.api_key = OPENAI_API_KEY
+        timing.set_status("ok")
+        response, latency = call_with_retry(
+            timed_call(openai.chat.completions.create),
+            policy=OPENAI_RETRY_POLICY, breaker=OPENAI_CIRCUIT_BREAKER,
+            **chat_request(system_prompt, prompt, model, response_format)
+        )
+        timing.add_usage(response.usage)
+        content = response.choices[0].message.content
+        if parse is not None:
+            # raises on a malformed response, so it is neither cached nor recorded
+            parse(content)
+        if OPENAI_FIXTURES is not None:
+            OPENAI_FIXTURES.add(
+                "chat", chat_cache_key(system_prompt, prompt, model, response_format), content, latency,
+                model=model, usage={
+                    "prompt_tokens": response.usage.prompt_tokens,
+                    "completion_tokens": response.usage.completion_tokens,
+                    "total_tokens": response.usage.total_tokens,
+                } if response.usage is not None else None
+            )
+        return content
+
+    with timing.timed(OPENAI_TIMING_LOG, kind=kind, model=model) as record:
+        if cache is None:
+            return create()
+        timing.set_status("cached")
+        content = cache.get_or_call(chat_cache_key(system_prompt, prompt, model, response_format), create)
+        if record["status"] == "cached" and content is not None:
+            # what the request would have cost, for comparing runs regardless of the cache
+            timing.add_count("cached_prompt_tokens", count_tokens(system_prompt + prompt, model))
+            timing.add_count("cached_completion_tokens", count_tokens(content, model))
+        return content
+
+
+def batch_chat_completions(
+    system_prompt, prompts, model, cache=None, poll_interval=30, response_format=None, parse=None
+):
+    # prompts maps custom ids to prompts; cached responses are not resubmitted.
+    # parse(custom_id, content) raises MalformedResponse for a response that
+    # is neither cached nor returned, so the caller asks for it again
+    def valid(custom_id, content):
+        if content is None or parse is None:
+            return content is not None
+        try:
+            parse(custom_id, content)
+        except MalformedResponse:
+            return False
+        return True
+
+    openai.api_key = OPENAI_API_KEY
+    results = {}
+    requests = []
+    for custom_id, prompt in prompts.items():
+        key = chat_cache_key(system_prompt, prompt, model, response_format)
+        cached = cache.get(key) if cache is not None else None
+        if valid(custom_id, cached):
+            results[custom_id] = cached
+        else:
+            requests.append((custom_id, chat_request(system_prompt, prompt, model, response_format)))
+
+    if requests:
+        with timing.timed(OPENAI_TIMING_LOG, kind="batch_api", model=model, requests=len(requests)):
+            batch_results = run_batch(requests, poll_interval=poll_interval)
+        for custom_id, content in batch_results.items():
+            if not valid(custom_id, content):
+                continue
+            if cache is not None:
+                cache.set(chat_cache_key(system_prompt, prompts[custom_id], model, response_format), content)
+            results[custom_id] = content
+
+    return results
+
+
+def response_format(schema):
+    if not STRUCTURED_OUTPUT:
+        return None
+    return {"type": "json_schema", "json_schema": schema}
+
+
+def complete_json(system_prompt, prompt, model, parse, cache=None, response_format=None, kind="chat"):
+    # asks again, with what was wrong appended to the prompt, only when the
+    # response does not parse
+    request_prompt = prompt
+    for _ in range(MALFORMED_REASKS + 1):
+        try:
+            content = chat_completion(
+                system_prompt, request_prompt, model, cache=cache,
+                response_format=response_format, kind=kind, parse=parse
+            )
+            return parse(content)
+        except MalformedResponse as exc:
+            error = exc
+            request_prompt = prompt + REASK_NOTE.format(exc)
+    raise error
+
+
+def ask_question(prompt, model, cache=None, question_count=None):
+    return complete_json(
+        ANSWER_SYSTEM_PROMPT, prompt, model,
+        functools.partial(parse_answers, question_count=question_count),
+        cache=cache, response_format=response_format(ANSWER_SCHEMA), kind="answer"
     )
-    answer = response.choices[0].message.content
-    return answer
 
 
 def read_question_and_answer(basepath, filename):
-    question_paths = glob(os.path.join(basepath, filename + "*"))
-    if len(question_paths) == 1:
-        question_path = question_paths[0]
+    question_path = question_index(basepath).get(filename)
+    if question_path is not None:
         with open(question_path, "r") as f:
             question_and_answer = json.load(f)
 
@@ -47,8 +219,8 @@ def read_question_and_answer(basepath, filename):
             answer_str = json.dumps(answer_only, indent=2)
 
     else:
-        print("Error: Multiple question files found for: ", filename)
-        exit(0)
+        # raised, not exit(), so the document is dead-lettered and the run goes on
+        raise FileNotFoundError("No unique question file found for: {}".format(filename))
 
     return question_str, answer_str
 
@@ -58,20 +230,32 @@ def prepare_question_prompt(
     content_key="<CONTENTSECTION>",
     question_key="<QUESTIONSECTION>"
 ):
+    template = compile_template(template)
+    return template.render({content_key: content, question_key: question})
 
-    template = template.replace(content_key, content)
-    template = template.replace(question_key, question)
 
-    return template
+def content_token_budget(template, question, model, max_prompt_tokens):
+    # tokens left for the document once the system prompt, the fixed
+    # template text and the questions are accounted for
+    fixed = ANSWER_SYSTEM_PROMPT + compile_template(template).static_text + question
+    return max_prompt_tokens - count_tokens(fixed, model)
 
 
-def reformat_answer(answer):
-    if "```" in answer and "json" in answer:
-        answer = answer[7:]
-        answer = answer[:-3]
+def prepare_question_prompts(
+    template, content, question,
+    model=None, max_prompt_tokens=None, overflow_policy="truncate"
+):
+    # one prompt, or one per chunk when the content is chunked to fit
+    if max_prompt_tokens is None:
+        return [prepare_question_prompt(template, content, question)]
 
-    answer = json.loads(answer)
-    return answer
+    budget = content_token_budget(template, question, model, max_prompt_tokens)
+    if budget <= 0:
+        raise ValueError("Questions and template alone exceed {} tokens".format(max_prompt_tokens))
+    return [
+        prepare_question_prompt(template, piece, question)
+        for piece in fit_content(content, budget, model, overflow_policy)
+    ]
 
 
 def prepare_eval_prompt(template, ref_answer, model_answer):
@@ -79,40 +263,141 @@ def prepare_eval_prompt(template, ref_answer, model_answer):
     ref_answer = str([elem for elem in ref_answer])
     model_answers = str([elem["short_answer"] for elem in model_answer])
 
-    template = template.replace("<REFERENCEANSWERSECTION>", ref_answer)
-    template = template.replace("<MODELANSWERSECTION>", model_answers)
+    template = compile_template(template).render({
+        "<REFERENCEANSWERSECTION>": ref_answer,
+        "<MODELANSWERSECTION>": model_answers,
+    })
 
     return template, ref_answer, model_answers
 
 
-def evaluate(evaluate_prompt, model):
-    openai.api_key = OPENAI_API_KEY
-    response = openai.chat.completions.create(
-        model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a helpful AI assistant that evaluates list of model answers given the reference answer."
-            },
-            {
-                "role": "user", "content": evaluate_prompt
-            }
-        ]
+def evaluate(evaluate_prompt, model, cache=None, count=None):
+    return complete_json(
+        EVALUATE_SYSTEM_PROMPT, evaluate_prompt, model,
+        functools.partial(parse_scores, count=count),
+        cache=cache, response_format=response_format(SCORES_SCHEMA), kind="evaluate"
+    )
+
+
+def valid_scores(evaluate_result, count):
+    # a batch API result that does not parse is asked for again on its own
+    if evaluate_result is None:
+        return None
+    try:
+        return parse_scores(evaluate_result, count)
+    except MalformedResponse:
+        return None
+
+
+def judged_answers(document):
+    # the answer pairs the LLM judge still has to score; with local scoring
+    # this is only the pairs the local scorer could not decide
+    ref_answer = json.loads(document["reference_answers"])
+    model_answers = [elem["short_answer"] for elem in document["answer"]]
+
+    local_scores = document.get("local_scores")
+    if local_scores is not None:
+        ambiguous = [idx for idx, score in enumerate(local_scores) if score is None]
+        ref_answer = [ref_answer[idx] for idx in ambiguous]
+        model_answers = [model_answers[idx] for idx in ambiguous]
+
+    return ref_answer, model_answers
+
+
+def apply_local_scoring(document, report):
+    ref_answer = json.loads(document["reference_answers"])
+    model_answers = [elem["short_answer"] for elem in document["answer"]]
+    if len(ref_answer) != len(model_answers):
+        return None
+
+    local_scores = score_locally(ref_answer, model_answers)
+    report.record(local_scores)
+    document["local_scores"] = local_scores
+    return local_scores
+
+
+def pack_eval_batches(documents, token_budget, model=None):
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for document in documents:
+        ref_answer, model_answers = judged_answers(document)
+        entry = {
+            "id": str(len(batch)),
+            "reference_answers": ref_answer,
+            "model_answers": model_answers,
+        }
+        tokens = count_tokens(json.dumps(entry), model)
+        if batch and batch_tokens + tokens > token_budget:
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+            entry["id"] = "0"
+        batch.append((document, entry))
+        batch_tokens += tokens
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def prepare_batch_eval_prompt(template, batch):
+    entries = [entry for _, entry in batch]
+    return compile_template(template).render({
+        "<DOCUMENTSECTION>": json.dumps(entries, indent=2, ensure_ascii=False)
+    })
+
+
+def evaluate_batch(evaluate_prompt, model, cache=None):
+    scores = chat_completion(
+        BATCH_EVALUATE_SYSTEM_PROMPT, evaluate_prompt, model, cache=cache,
+        response_format={"type": "json_schema", "json_schema": BATCH_EVAL_SCHEMA},
+        kind="evaluate_batch", parse=batch_documents
     )
-    scores = response.choices[0].message.content
     return scores
 
 
+def batch_documents(scores):
+    # a packed evaluation without a documents array is neither cached nor used
+    documents = find_json_array(scores, "documents")
+    if documents is None:
+        raise MalformedResponse("no JSON array of documents found")
+    return documents
+
+
+def split_batch_scores(batch, scores):
+    # map each document of the batch to its own score list; documents whose
+    # scores are missing or have the wrong length map to None
+    scored = batch_documents(scores)
+
+    scores_by_id = {}
+    for elem in scored:
+        if isinstance(elem, dict) and "id" in elem and isinstance(elem.get("scores"), list):
+            scores_by_id[str(elem["id"])] = elem["scores"]
+
+    split = []
+    for document, entry in batch:
+        document_scores = scores_by_id.get(entry["id"])
+        if document_scores is not None:
+            try:
+                document_scores = validate_scores(document_scores, len(entry["model_answers"]))
+            except MalformedResponse:
+                document_scores = None
+        split.append((document, document_scores))
+    return split
+
+
 def reformat_scores(questions, ref_str, model_str, scores):
     question_text = ""
     for idx, question_elem in enumerate(json.loads(questions)):
         question_text += str(idx+1) + ". " + question_elem["question"] + "\n"
 
-    if "```" in scores and "list" in scores:
-        scores = scores[7:]
-        scores = scores[:-3]
+    # scores is either the raw evaluation response or a list that was
+    # already demultiplexed from a batch or merged with local scores
+    if isinstance(scores, str):
+        scores = parse_scores(scores)
 
-    scores = list(json.loads(scores))
+    scores = list(scores)
 
     scores_text = ""
     scores_text += "Questions: \n" + question_text
@@ -125,6 +410,325 @@ def reformat_scores(questions, ref_str, model_str, scores):
     return scores, scores_text
 
 
+def read_document(file_path, question_basepath, input_key=None, contents=None):
+    # file_path is an extracted .txt file, or an item of the contents store
+    if contents is None:
+        with open(file_path, "r") as f:
+            content = f.read()
+    else:
+        content = contents.read(file_path)
+
+    question, reference_answers = read_question_and_answer(question_basepath, document_basename(file_path))
+    input_hash = make_key("qa", input_key, content, question, reference_answers)
+    return content, question, reference_answers, input_hash
+
+
+def current_entries(manifest, file_paths, question_basepath, input_key=None, contents=None):
+    # manifest entries scored on the documents' current content, questions,
+    # templates and models; stale scores and unreadable documents are left out
+    entries = []
+    for file_path in file_paths:
+        try:
+            _, question, _, input_hash = read_document(file_path, question_basepath, input_key, contents)
+        except (OSError, KeyError, ValueError):
+            continue
+        entry = manifest.get(document_basename(file_path), input_hash)
+        if entry is not None:
+            entries.append((entry, question))
+    return entries
+
+
+def prepare_document(
+    file_path, question_template, question_basepath, save_basepath,
+    manifest=None, input_key=None, contents=None, output=None,
+    model=None, max_prompt_tokens=None, overflow_policy="truncate", retrieval=None
+):
+    basename = document_basename(file_path)
+    content, question, reference_answers, input_hash = read_document(
+        file_path, question_basepath, input_key, contents
+    )
+
+    document = {
+        "file_path": file_path,
+        "basename": basename,
+        "output": output or DirectoryOutput(save_basepath),
+        "input_hash": input_hash,
+        "question": question,
+        "reference_answers": reference_answers,
+    }
+
+    if manifest is not None:
+        entry = manifest.get(basename, input_hash)
+        if entry is not None:
+            document["scores"] = entry["scores"]
+            return document
+
+    if retrieval is not None:
+        # only the chunks relevant to the questions go into the prompt
+        content = retrieval.select(content, json.loads(question), model)
+    question_prompts = prepare_question_prompts(
+        question_template, content, question,
+        model=model, max_prompt_tokens=max_prompt_tokens, overflow_policy=overflow_policy
+    )
+    document["question_prompt"] = question_prompts[0]
+    if len(question_prompts) > 1:
+        document["question_prompts"] = question_prompts
+    return document
+
+
+def merge_chunk_answers(chunk_answers):
+    # the first non-empty answer to each question across the chunks
+    answer = chunk_answers[0]
+    for chunk_answer in chunk_answers[1:]:
+        if len(chunk_answer) != len(answer):
+            continue
+        for elem, chunk_elem in zip(answer, chunk_answer):
+            if not str(elem.get("short_answer", "")).strip():
+                elem["short_answer"] = chunk_elem.get("short_answer", "")
+    return answer
+
+
+def question_count(document):
+    return len(json.loads(document["question"]))
+
+
+def answer_prompts(document, model, cache=None):
+    chunk_answers = [
+        ask_question(prompt, model, cache=cache, question_count=question_count(document))
+        for prompt in document.get("question_prompts", [document["question_prompt"]])
+    ]
+    if len(chunk_answers) == 1:
+        return chunk_answers[0]
+    return merge_chunk_answers(chunk_answers)
+
+
+def save_answer(document, answer):
+    document["answer"] = answer
+
+    prompts = document.get("question_prompts", [document["question_prompt"]])
+    document["output"].write(document["basename"], "prompt", "\n\n".join(prompts))
+    document["output"].write(document["basename"], "answer", json.dumps(answer, indent=2, ensure_ascii=False))
+
+    return document
+
+
+def answer_document(
+    file_path, question_template, question_basepath, answering_model, save_basepath,
+    cache=None, manifest=None, input_key=None, contents=None, output=None,
+    max_prompt_tokens=None, overflow_policy="truncate", retrieval=None
+):
+    document = prepare_document(
+        file_path, question_template, question_basepath, save_basepath,
+        manifest=manifest, input_key=input_key, contents=contents, output=output,
+        model=answering_model, max_prompt_tokens=max_prompt_tokens, overflow_policy=overflow_policy,
+        retrieval=retrieval
+    )
+    if "scores" in document:
+        return document
+
+    with timing.labels(item=document["basename"]):
+        answer = answer_prompts(document, answering_model, cache=cache)
+    return save_answer(document, answer)
+
+
+def save_scores(document, reference_list, answer_list, scores, manifest=None, on_scored=None):
+    scores_list, scores_text = reformat_scores(
+        document["question"], reference_list, answer_list, scores
+    )
+
+    eval_save_path = document["output"].write(
+        document["basename"], "scores", scores_text, scores=scores_list
+    )
+
+    if manifest is not None:
+        manifest.mark_done(
+            document["basename"], document["input_hash"],
+            output=eval_save_path, scores=scores_list
+        )
+    document["scores"] = scores_list
+    if on_scored is not None:
+        on_scored(document)
+
+    return scores_list
+
+
+def prepare_judge_prompt(document, eval_template, report=None):
+    # the prompt still to send to the judge, or None if the local scorer
+    # already decided every answer
+    local_scores = document.get("local_scores")
+    if local_scores is None and report is not None:
+        local_scores = apply_local_scoring(document, report)
+
+    if local_scores is None:
+        evaluate_prompt, _, _ = prepare_eval_prompt(
+            eval_template, document["reference_answers"], document["answer"]
+        )
+        return evaluate_prompt
+    if None not in local_scores:
+        return None
+
+    ref_answer, model_answers = judged_answers(document)
+    evaluate_prompt, _, _ = prepare_eval_prompt(
+        eval_template, json.dumps(ref_answer), [{"short_answer": answer} for answer in model_answers]
+    )
+    return evaluate_prompt
+
+
+def combine_scores(document, evaluate_result):
+    local_scores = document.get("local_scores")
+    if local_scores is None:
+        return evaluate_result
+    if None not in local_scores:
+        return local_scores
+
+    if len(evaluate_result) != local_scores.count(None):
+        return None
+    return merge_scores(local_scores, evaluate_result)
+
+
+def evaluate_document(
+    document, eval_template, evaluate_model,
+    cache=None, manifest=None, on_scored=None, report=None, evaluate_result=None
+):
+    if "scores" in document:
+        return document["scores"]
+
+    evaluate_prompt, reference_list, answer_list = prepare_eval_prompt(
+        eval_template, document["reference_answers"], document["answer"]
+    )
+
+    judge_prompt = prepare_judge_prompt(document, eval_template, report)
+    with timing.labels(item=document["basename"]):
+        if judge_prompt is not None:
+            judged_count = len(judged_answers(document)[1])
+            evaluate_result = valid_scores(evaluate_result, judged_count)
+            if evaluate_result is None:
+                evaluate_result = evaluate(judge_prompt, evaluate_model, cache=cache, count=judged_count)
+
+        scores = combine_scores(document, evaluate_result)
+        if scores is None:
+            # the judge did not return one score per undecided answer
+            scores = evaluate(evaluate_prompt, evaluate_model, cache=cache, count=len(document["answer"]))
+
+    return save_scores(
+        document, reference_list, answer_list, scores,
+        manifest=manifest, on_scored=on_scored
+    )
+
+
+def evaluate_document_batch(
+    batch, batch_template, eval_template, evaluate_model,
+    cache=None, manifest=None, on_scored=None, report=None
+):
+    evaluate_prompt = prepare_batch_eval_prompt(batch_template, batch)
+    with timing.labels(documents=len(batch)):
+        evaluate_result = evaluate_batch(evaluate_prompt, evaluate_model, cache=cache)
+
+    for document, scores in split_batch_scores(batch, evaluate_result):
+        if scores is None:
+            # fall back to a single-document request for anything the batch missed
+            evaluate_document(
+                document, eval_template, evaluate_model,
+                cache=cache, manifest=manifest, on_scored=on_scored, report=report
+            )
+            continue
+
+        if document.get("local_scores") is not None:
+            scores = merge_scores(document["local_scores"], scores)
+
+        _, reference_list, answer_list = prepare_eval_prompt(
+            eval_template, document["reference_answers"], document["answer"]
+        )
+        save_scores(
+            document, reference_list, answer_list, scores,
+            manifest=manifest, on_scored=on_scored
+        )
+
+    return [document["scores"] for document, _ in batch]
+
+
+def write_final_score(save_basepath, all_scores):
+    avg_score = sum(all_scores) / len(all_scores) if all_scores else 0.0
+    return write_score_file(save_basepath, avg_score, len(all_scores))
+
+
+def merge_shards(save_basepath, shard_count, question_basepath, aggregator):
+    # one final score and breakdown over the documents scored by every shard
+    all_scores = []
+    for index in range(shard_count):
+        manifest = open_manifest(shard_dir(save_basepath, (index, shard_count)))
+        for entry in manifest.snapshot():
+            if "scores" not in entry:
+                continue
+            all_scores += entry["scores"]
+            question, _ = read_question_and_answer(question_basepath, entry["item"])
+            aggregator.add(entry["item"], json.loads(question), entry["scores"])
+    return write_final_score(save_basepath, all_scores)
+
+
+def run_summary(save_basepath, items):
+    # accuracy, answer prompt tokens per document and answer latency of a
+    # run directory, over the given documents
+    scores_by_item = {entry["item"]: entry["scores"] for entry in open_manifest(save_basepath).snapshot(items)}
+    scores = [score for item in items for score in scores_by_item.get(item, [])]
+    records = [
+        record for record in timing.latest_run_records(save_basepath)
+        if record["kind"] == "answer" and record.get("item") in scores_by_item
+    ]
+    prompt_tokens = sum(record.get("prompt_tokens", 0) + record.get("cached_prompt_tokens", 0) for record in records)
+    latencies = [record["latency"] for record in records if record["status"] == "ok"]
+    return {
+        "documents": len(scores_by_item),
+        "questions": len(scores),
+        "accuracy": sum(scores) / len(scores) if scores else None,
+        "prompt_tokens_per_document": prompt_tokens / len(scores_by_item) if scores_by_item else None,
+        "answer_p50": timing.percentile(latencies, 50),
+        "answer_p95": timing.percentile(latencies, 95),
+    }
+
+
+def compare_with_baseline(save_basepath, baseline_basepath, basenames):
+    # this run against another run, e.g. retrieval against full context, on
+    # the documents both have scored
+    baseline_items = {entry["item"] for entry in open_manifest(baseline_basepath).snapshot()}
+    items = [basename for basename in basenames if basename in baseline_items]
+    comparison = {
+        "baseline": baseline_basepath,
+        "run": run_summary(save_basepath, items),
+        "baseline_run": run_summary(baseline_basepath, items),
+    }
+    atomic_write(os.path.join(save_basepath, "comparison.json"), json.dumps(comparison, indent=2))
+    return comparison
+
+
+def format_comparison(comparison):
+    rows = [
+        ("documents", "{}"),
+        ("questions", "{}"),
+        ("accuracy", "{:.4f}"),
+        ("prompt_tokens_per_document", "{:.0f}"),
+        ("answer_p50", "{:.3f}"),
+        ("answer_p95", "{:.3f}"),
+    ]
+    lines = ["{:<28} {:>12} {:>12}".format("", "this run", "baseline")]
+    for name, spec in rows:
+        values = [comparison["run"][name], comparison["baseline_run"][name]]
+        lines.append("{:<28} {:>12} {:>12}".format(
+            name, *["-" if value is None else spec.format(value) for value in values]
+        ))
+    return "\n".join(lines)
+
+
+def write_score_file(save_basepath, avg_score, total_questions):
+    score_path = os.path.join(save_basepath, "final_score.txt")
+    atomic_write(
+        score_path,
+        "Mean score: {:.4f}\n".format(avg_score) + "Total number of questions: {}".format(total_questions)
+    )
+
+    return avg_score, total_questions
+
+
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser()
     argparser.add_argument("--content_path", type=str, default="", required=True)
@@ -134,65 +738,345 @@ if __name__ == "__main__":
     argparser.add_argument("--answering_model", type=str, default="gpt-4o")
     argparser.add_argument("--evaluate_model", type=str, default="gpt-4o")
     argparser.add_argument("--save_basepath", type=str, default="results/")
+    argparser.add_argument("--answer_concurrency", type=int, default=8)
+    argparser.add_argument("--evaluate_concurrency", type=int, default=8)
+    argparser.add_argument("--adaptive_concurrency", action="store_true")
+    argparser.add_argument("--max_concurrency", type=int, default=None)
+    argparser.add_argument("--queue_size", type=int, default=16)
+    argparser.add_argument("--cache_path", type=str, default=".cache/responses.sqlite")
+    argparser.add_argument("--cache_max_mb", type=float, default=1024)
+    argparser.add_argument("--rerun", action="store_true")
+    argparser.add_argument("--batch_evaluate_template_path", type=str, default="dataset/templates/batch_evaluate_template.txt")
+    argparser.add_argument("--eval_batch_tokens", type=int, default=0)
+    argparser.add_argument("--local_scoring", action="store_true")
+    argparser.add_argument("--batch_api", action="store_true")
+    argparser.add_argument("--batch_poll_interval", type=float, default=30)
+    argparser.add_argument("--openai_base_url", type=str, default=None)
+    argparser.add_argument("--max_attempts", type=int, default=5)
+    argparser.add_argument("--replay_dead_letters", action="store_true")
+    argparser.add_argument("--timing_parquet", action="store_true")
+    argparser.add_argument("--record_fixtures", type=str, default=None)
+    argparser.add_argument("--no_structured_output", action="store_true")
+    argparser.add_argument("--malformed_reasks", type=int, default=2)
+    argparser.add_argument("--retrieval_top_k", type=int, default=0)
+    argparser.add_argument("--chunk_tokens", type=int, default=512)
+    argparser.add_argument("--compare_with", type=str, default=None)
+    argparser.add_argument("--result_store", type=str, default=None)
+    argparser.add_argument("--context_tokens", type=int, default=None)
+    argparser.add_argument("--max_completion_tokens", type=int, default=4096)
+    argparser.add_argument("--overflow_policy", type=str, default="truncate", choices=["truncate", "chunk", "error"])
+    argparser.add_argument("--parser", type=str, default=None)
+    argparser.add_argument("--confidence", type=float, default=0.95)
+    argparser.add_argument("--stop_ci_width", type=float, default=0)
+    argparser.add_argument("--min_questions", type=int, default=200)
+    argparser.add_argument("--seed", type=int, default=0)
+    argparser.add_argument("--shard", type=parse_shard, default=None)
+    argparser.add_argument("--merge_shards", type=int, default=None)
     args = argparser.parse_args()
 
-    file_paths = glob(os.path.join(args.content_path, "*.txt"))
+    parser_label = args.parser or os.path.basename(os.path.normpath(args.content_path))
+    if args.merge_shards:
+        # combine the outputs of run_qa_eval.py --shard i/N for every i
+        aggregator = ScoreAggregator(parser=parser_label, confidence=args.confidence)
+        avg_score, total_questions = merge_shards(
+            args.save_basepath, args.merge_shards, args.question_basepath, aggregator
+        )
+        BreakdownWriter(
+            aggregator,
+            os.path.join(args.save_basepath, "score_breakdown.json"),
+            os.path.join(args.save_basepath, "score_breakdown.txt"),
+        ).write(force=True)
+        print("Mean score: {:.4f}".format(avg_score))
+        print("Total number of questions: {}".format(total_questions))
+        print(format_breakdown(aggregator.summary()))
+        timing.merge_reports(
+            args.save_basepath,
+            [shard_dir(args.save_basepath, (index, args.merge_shards)) for index in range(args.merge_shards)],
+            parquet=args.timing_parquet,
+        )
+        if args.result_store:
+            merge_stores(
+                args.result_store,
+                [shard_path(args.result_store, (index, args.merge_shards)) for index in range(args.merge_shards)],
+            )
+        exit(0)
+    if args.shard:
+        args.save_basepath = shard_dir(args.save_basepath, args.shard)
+        if args.result_store:
+            args.result_store = shard_path(args.result_store, args.shard)
 
-    counter = 0
-    all_scores = []
-    for file_path in file_paths:
-        if "time.txt" in file_path:
-            continue
-        print("({}/{}) Processing file: ".format(counter+1, len(file_paths)), file_path)
+    OPENAI_RETRY_POLICY.max_attempts = args.max_attempts
+    OPENAI_TIMING_LOG = timing.open_timing_log(args.save_basepath)
+    OPENAI_FIXTURES = open_recorder(args.record_fixtures)
+    STRUCTURED_OUTPUT = not args.no_structured_output
+    MALFORMED_REASKS = args.malformed_reasks
+
+    answer_concurrency, evaluate_concurrency = args.answer_concurrency, args.evaluate_concurrency
+    if args.adaptive_concurrency:
+        # each stage adapts its own limit, up to --max_concurrency in flight
+        answer_concurrency = AdaptiveConcurrency(
+            initial=args.answer_concurrency, maximum=args.max_concurrency or 4 * args.answer_concurrency
+        )
+        evaluate_concurrency = AdaptiveConcurrency(
+            initial=args.evaluate_concurrency, maximum=args.max_concurrency or 4 * args.evaluate_concurrency
+        )
+
+    cache = open_cache(args.cache_path, args.cache_max_mb)
+    report = ScoringReport() if args.local_scoring else None
+    if args.openai_base_url:
+        openai.base_url = args.openai_base_url
+    os.makedirs(args.save_basepath, exist_ok=True)
+    manifest = open_manifest(args.save_basepath, rerun=args.rerun)
+    dead_letters = open_dead_letters(args.save_basepath)
 
-        basename = '.'.join(os.path.basename(file_path).split(".")[:-1])
+    contents = None
+    if args.content_path.endswith(".jsonl") and not os.path.exists(args.content_path):
+        argparser.error("{} does not exist; merge sharded stores with extract_contents.py --merge_shards N".format(
+            args.content_path
+        ))
+    if is_store_path(args.content_path):
+        # contents written by extract_contents.py --result_store
+        contents = StoreContents(ResultStore(args.content_path))
+        file_paths = [item for item in contents.items() if args.shard is None or in_shard(item, args.shard)]
+    else:
+        file_paths = get_content_path_list(args.content_path, shard=args.shard)
+    # checked over every shard, so all shards agree on what is rejected
+    duplicates = duplicate_basenames(
+        file_paths if args.shard is None
+        else contents.items() if contents is not None
+        else get_content_path_list(args.content_path)
+    )
+    if duplicates:
+        argparser.error("documents in different directories share a basename: {}".format("; ".join(
+            ", ".join(paths) for paths in list(duplicates.values())[:5]
+        )))
+    results = ResultStore(args.result_store) if args.result_store else None
+    output = StoreOutput(results) if results is not None else None
+    basenames = [document_basename(file_path) for file_path in file_paths]
+    all_file_paths = list(file_paths)
+    if args.replay_dead_letters:
+        file_paths = dead_letters.take()
 
-        save_basepath = os.path.join(args.save_basepath, basename)
-        if not os.path.exists(save_basepath):
-            os.makedirs(save_basepath)
+    # templates are compiled once; their fixed instructions and examples come
+    # before the document, so the prompt prefix is the same for every request
+    with open(args.question_template_path, "r") as f:
+        question_template = PromptTemplate(f.read())
 
-        with open(args.question_template_path, "r") as f:
-            question_template = f.read()
+    with open(args.evaluate_template_path, "r") as f:
+        eval_template = PromptTemplate(f.read())
 
-        with open(args.evaluate_template_path, "r") as f:
-            eval_template = f.read()
+    max_prompt_tokens = context_tokens(args.answering_model, args.context_tokens) - args.max_completion_tokens
 
-        with open(file_path, "r") as f:
-            content = f.read()
+    # running per-category / question type / document counts, seeded with
+    # the documents scored by earlier runs
+    aggregator = ScoreAggregator(
+        parser=parser_label,
+        confidence=args.confidence
+    )
+    breakdown = BreakdownWriter(
+        aggregator,
+        os.path.join(args.save_basepath, "score_breakdown.json"),
+        os.path.join(args.save_basepath, "score_breakdown.txt"),
+    )
+
+    # with --stop_ci_width, documents not yet started are skipped once the
+    # overall score has converged
+    stop = threading.Event()
+    if args.stop_ci_width:
+        # a random order keeps the partial score an unbiased estimate
+        random.Random(args.seed).shuffle(file_paths)
+
+    # keep final_score.txt current so an interrupted run still has a partial score
+    score_lock = threading.Lock()
+
+    def update_final_score(document):
+        aggregator.add(document["basename"], json.loads(document["question"]), document["scores"])
+        overall = aggregator.overall()
+        with score_lock:
+            write_score_file(args.save_basepath, overall["mean"], overall["total"])
+        breakdown.write()
+
+        if args.stop_ci_width and not stop.is_set() and aggregator.converged(args.stop_ci_width, args.min_questions):
+            stop.set()
+            print("Stopping early: mean {:.4f} [{:.4f}, {:.4f}] over {} questions".format(
+                overall["mean"], overall["ci_low"], overall["ci_high"], overall["total"]
+            ))
+
+    def unless_stopped(fn):
+        def wrapper(arg, **kwargs):
+            if stop.is_set():
+                return None
+            return fn(arg, **kwargs)
+        return wrapper
 
-        question, reference_answers = read_question_and_answer(args.question_basepath, basename)
-        question_prompt = prepare_question_prompt(question_template, content, question)
-        answer = ask_question(question_prompt, args.answering_model)
+    retrieval = None
+    if args.retrieval_top_k > 0:
+        retrieval = RetrievalOptions(top_k=args.retrieval_top_k, chunk_tokens=args.chunk_tokens)
+    input_key = [
+        question_template.text, eval_template.text, args.answering_model, args.evaluate_model,
+        max_prompt_tokens, args.overflow_policy
+    ]
+    if retrieval is not None:
+        input_key.append(retrieval.key())
+    for entry, question in current_entries(manifest, all_file_paths, args.question_basepath, input_key, contents):
+        aggregator.add(entry["item"], json.loads(question), entry["scores"])
+    answer_stage = unless_stopped(dead_letter_on_failure(functools.partial(
+        answer_document,
+        question_template=question_template,
+        question_basepath=args.question_basepath,
+        answering_model=args.answering_model,
+        save_basepath=args.save_basepath,
+        cache=cache,
+        manifest=manifest,
+        input_key=input_key,
+        contents=contents,
+        output=output,
+        max_prompt_tokens=max_prompt_tokens,
+        overflow_policy=args.overflow_policy,
+        retrieval=retrieval,
+    ), dead_letters))
+    evaluate_stage = dead_letter_on_failure(functools.partial(
+        evaluate_document,
+        eval_template=eval_template,
+        evaluate_model=args.evaluate_model,
+        cache=cache,
+        manifest=manifest,
+        on_scored=update_final_score,
+        report=report,
+    ), dead_letters, item=lambda document: document["file_path"])
+    if args.batch_api:
+        # offline batch jobs: answer every document, then evaluate every document
+        prepare_stage = dead_letter_on_failure(functools.partial(
+            prepare_document,
+            question_template=question_template,
+            question_basepath=args.question_basepath,
+            save_basepath=args.save_basepath,
+            manifest=manifest,
+            input_key=input_key,
+            contents=contents,
+            output=output,
+            model=args.answering_model,
+            max_prompt_tokens=max_prompt_tokens,
+            overflow_policy=args.overflow_policy,
+            retrieval=retrieval,
+        ), dead_letters)
+        documents = [prepare_stage(file_path) for file_path in file_paths]
+        pending = [document for document in documents if document is not None and "scores" not in document]
 
-        json_answer = reformat_answer(answer)
+        pending_by_basename = {document["basename"]: document for document in pending}
 
-        prompt_save_path = os.path.join(save_basepath, "prompt.txt")
-        with open(prompt_save_path, "w") as f:
-            f.write(question_prompt)
+        # chunked documents are answered interactively after the batch
+        answers = batch_chat_completions(
+            ANSWER_SYSTEM_PROMPT,
+            {
+                document["basename"]: document["question_prompt"]
+                for document in pending if "question_prompts" not in document
+            },
+            args.answering_model, cache=cache, poll_interval=args.batch_poll_interval,
+            response_format=response_format(ANSWER_SCHEMA),
+            parse=lambda basename, content: parse_answers(content, question_count(pending_by_basename[basename]))
+        )
+        def finish_answer(document):
+            try:
+                answer = parse_answers(answers.get(document["basename"]), question_count(document))
+            except MalformedResponse:
+                # missing or malformed batch answers are asked again on their own
+                answer = answer_prompts(document, args.answering_model, cache=cache)
+            return save_answer(document, answer)
 
-        evaluate_prompt, reference_list, answer_list = prepare_eval_prompt(
-            eval_template, reference_answers, json_answer
+        finish_answer = dead_letter_on_failure(finish_answer, dead_letters, item=lambda document: document["file_path"])
+        pending = [document for document in pending if finish_answer(document) is not None]
+
+        judge_prompts = {}
+        for document in pending:
+            judge_prompt = prepare_judge_prompt(document, eval_template, report)
+            if judge_prompt is not None:
+                judge_prompts[document["basename"]] = judge_prompt
+
+        evaluate_results = batch_chat_completions(
+            EVALUATE_SYSTEM_PROMPT, judge_prompts,
+            args.evaluate_model, cache=cache, poll_interval=args.batch_poll_interval,
+            response_format=response_format(SCORES_SCHEMA),
+            parse=lambda basename, content: parse_scores(
+                content, len(judged_answers(pending_by_basename[basename])[1])
+            )
         )
-        evaluate_result = evaluate(evaluate_prompt, args.evaluate_model)
-        scores_list, scores_text = reformat_scores(
-            question, reference_list, answer_list, evaluate_result
+        for document in pending:
+            evaluate_stage(document, evaluate_result=evaluate_results.get(document["basename"]))
+
+    elif args.eval_batch_tokens > 0:
+        # batched evaluation packs many documents into one request, so all
+        # answers are collected first and then evaluated batch by batch
+        with open(args.batch_evaluate_template_path, "r") as f:
+            batch_template = PromptTemplate(f.read())
+
+        documents = run(
+            file_paths, answer_stage,
+            concurrency=answer_concurrency, desc="Answering"
         )
+        pending = [document for document in documents if document is not None and "scores" not in document]
+        if report is not None:
+            for document in pending:
+                if apply_local_scoring(document, report) is not None and None not in document["local_scores"]:
+                    evaluate_stage(document)
+            pending = [document for document in pending if "scores" not in document]
 
-        all_scores += scores_list
+        batches = pack_eval_batches(pending, args.eval_batch_tokens, args.evaluate_model)
+        batch_stage = functools.partial(
+            evaluate_document_batch,
+            batch_template=batch_template,
+            eval_template=eval_template,
+            evaluate_model=args.evaluate_model,
+            cache=cache,
+            manifest=manifest,
+            on_scored=update_final_score,
+            report=report,
+        )
 
-        eval_save_path = os.path.join(save_basepath, "scores.txt")
-        with open(eval_save_path, "w") as f:
-            f.write(scores_text)
+        def evaluate_batch_stage(batch):
+            try:
+                return batch_stage(batch)
+            except Exception:
+                # evaluate documents of a failed batch one by one
+                return [evaluate_stage(document) for document, _ in batch]
 
-        counter += 1
+        run(batches, evaluate_batch_stage, concurrency=evaluate_concurrency, desc="Evaluating batches")
+        print("Evaluated {} documents in {} requests".format(
+            sum(len(batch) for batch in batches), len(batches)
+        ))
+    else:
+        run_stages(
+            file_paths,
+            [(answer_stage, answer_concurrency), (evaluate_stage, evaluate_concurrency)],
+            queue_size=args.queue_size,
+            desc="Processing files",
+        )
 
-    avg_score = sum(all_scores) / len(all_scores)
-    total_questions = len(all_scores)
+    # documents scored in earlier runs or replays count toward the final score,
+    # as long as nothing they were scored on has changed since
+    all_scores = []
+    for entry, _ in current_entries(manifest, all_file_paths, args.question_basepath, input_key, contents):
+        all_scores += entry["scores"]
 
-    score_path = os.path.join(args.save_basepath, "final_score.txt")
-    with open(score_path, "w") as f:
-        f.write("Mean score: {:.4f}\n".format(avg_score))
-        f.write("Total number of questions: {}".format(total_questions))
+    avg_score, total_questions = write_final_score(args.save_basepath, all_scores)
 
     print("Mean score: {:.4f}".format(avg_score))
-    print("Total number of questions: ".format(total_questions))
+    print("Total number of questions: {}".format(total_questions))
+    breakdown.write(force=True)
+    print(format_breakdown(aggregator.summary()))
+    if args.replay_dead_letters:
+        dead_letters.finish_replay()
+    distributed.report(dead_letters=len(dead_letters))
+    if len(dead_letters):
+        print("Failed documents: {} (see {}, rerun with --replay_dead_letters)".format(
+            len(dead_letters), dead_letters.path
+        ))
+    if report is not None:
+        print(report.summary())
+    if results is not None:
+        results.close()
+    timing.write_report(OPENAI_TIMING_LOG, args.save_basepath, parquet=args.timing_parquet)
+    if args.compare_with:
+        comparison = compare_with_baseline(args.save_basepath, args.compare_with, basenames)
+        print(format_comparison(comparison))
+    print_stats(cache)
@@ -0,0 +1,108 @@
+import re
+import json
+
+ANSWER_SCHEMA = {
+    "name": "answers",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "answers": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "category": {"type": "string"},
+                        "question_type": {"type": "string"},
+                        "question": {"type": "string"},
+                        "short_answer": {"type": "string"},
+                    },
+                    "required": ["category", "question_type", "question", "short_answer"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["answers"],
+        "additionalProperties": False,
+    },
+}
+
+SCORES_SCHEMA = {
+    "name": "scores",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "scores": {"type": "array", "items": {"type": "integer", "enum": [0, 1]}},
+        },
+        "required": ["scores"],
+        "additionalProperties": False,
+    },
+}
+
+JSON_START = re.compile(r"[\[{]")
+
+
+class MalformedResponse(ValueError):
+    pass
+
+
+def find_json_array(text, key=None):
+    # the first JSON array in a response: the response itself, the value of
+    # key in a JSON object, or an array inside code fences or prose
+    if not isinstance(text, str):
+        return None
+    try:
+        value = json.loads(text)
+    except json.JSONDecodeError:
+        value = None
+    if isinstance(value, list):
+        return value
+    if isinstance(value, dict):
+        return value.get(key) if isinstance(value.get(key), list) else None
+
+    decoder = json.JSONDecoder()
+    for match in JSON_START.finditer(text):
+        try:
+            value, _ = decoder.raw_decode(text, match.start())
+        except json.JSONDecodeError:
+            continue
+        if isinstance(value, list):
+            return value
+        if isinstance(value, dict) and isinstance(value.get(key), list):
+            return value[key]
+    return None
+
+
+def parse_answers(text, question_count=None):
+    answers = find_json_array(text, "answers")
+    if answers is None:
+        raise MalformedResponse("no JSON array of answers found")
+    if question_count is not None and len(answers) != question_count:
+        raise MalformedResponse("expected {} answers, got {}".format(question_count, len(answers)))
+    for idx, answer in enumerate(answers):
+        if not isinstance(answer, dict) or "short_answer" not in answer:
+            raise MalformedResponse("answer {} has no \"short_answer\" field".format(idx + 1))
+    return answers
+
+
+def validate_scores(scores, count=None):
+    if count is not None and len(scores) != count:
+        raise MalformedResponse("expected {} scores, got {}".format(count, len(scores)))
+    validated = []
+    for score in scores:
+        if isinstance(score, str) and score.strip() in ("0", "1"):
+            score = int(score)
+        if isinstance(score, float) and score in (0.0, 1.0):
+            score = int(score)
+        if score not in (0, 1):
+            raise MalformedResponse("score {!r} is not 0 or 1".format(score))
+        validated.append(int(score))
+    return validated
+
+
+def parse_scores(text, count=None):
+    scores = find_json_array(text, "scores")
+    if scores is None:
+        raise MalformedResponse("no JSON array of scores found")
+    return validate_scores(scores, count)
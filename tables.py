@@ -0,0 +1,174 @@
+import re
+
+from html.parser import HTMLParser
+
+HTML_TABLE = re.compile(r"<table\b.*?</table\s*>", re.I | re.S)
+SEPARATOR_ROW = re.compile(r"^\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?$")
+UNESCAPED_PIPE = re.compile(r"(?<!\\)\|")
+BLOCK_TAGS = {"p", "div", "ul", "ol", "section", "article", "header", "footer", "caption"}
+HEADING_TAGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+
+
+def clean_cell(text):
+    return " ".join(text.split()).replace("|", "\\|")
+
+
+def expand_spans(rows):
+    # rows of (text, row_span, column_span) -> a rectangular grid of strings;
+    # a merged cell keeps its text in its top-left position only
+    occupied = {}
+    for row_idx, row in enumerate(rows):
+        column = 0
+        for text, row_span, column_span in row:
+            while (row_idx, column) in occupied:
+                column += 1
+            for i in range(max(1, row_span)):
+                for j in range(max(1, column_span)):
+                    occupied[(row_idx + i, column + j)] = text if i == 0 and j == 0 else ""
+            column += max(1, column_span)
+
+    if not occupied:
+        return []
+    n_columns = max(column for _, column in occupied) + 1
+    return [[occupied.get((row, column), "") for column in range(n_columns)] for row in range(len(rows))]
+
+
+def table_markdown(grid):
+    # the canonical table: cells with collapsed whitespace, no alignment
+    # padding, empty rows and columns dropped, the first row as the header
+    rows = [[clean_cell(cell) for cell in row] for row in grid]
+    rows = [row for row in rows if any(row)]
+    if not rows:
+        return ""
+    width = max(len(row) for row in rows)
+    rows = [row + [""] * (width - len(row)) for row in rows]
+    keep = [column for column in range(width) if any(row[column] for row in rows)]
+    rows = [[row[column] for column in keep] for row in rows]
+
+    lines = [markdown_row(rows[0]), "|" + "|".join("---" for _ in keep) + "|"]
+    lines.extend(markdown_row(row) for row in rows[1:])
+    return "\n".join(lines)
+
+
+def markdown_row(cells):
+    return "|" + "|".join(" {} ".format(cell) if cell else " " for cell in cells) + "|"
+
+
+def span(attrs, name):
+    try:
+        return int(dict(attrs).get(name) or 1)
+    except ValueError:
+        return 1
+
+
+class TableHTMLParser(HTMLParser):
+    # streams through HTML: each <table> is collected into rows of cells and
+    # written as a canonical markdown table, other text is kept with
+    # headings, paragraphs and list items on their own lines
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.output = []
+        self.tables = []
+
+    def text(self, data):
+        table = self.tables[-1]
+        if table["cell"] is not None:
+            table["cell"][0].append(data)
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table":
+            self.tables.append({"rows": [], "cell": None})
+        elif self.tables:
+            table = self.tables[-1]
+            if tag == "tr":
+                table["rows"].append([])
+            elif tag in ("td", "th"):
+                if not table["rows"]:
+                    table["rows"].append([])
+                table["cell"] = ([], span(attrs, "rowspan"), span(attrs, "colspan"))
+                table["rows"][-1].append(table["cell"])
+            elif tag == "br":
+                self.text(" ")
+        elif tag == "br":
+            self.output.append("\n")
+        elif tag in HEADING_TAGS:
+            self.output.append("\n" + "#" * HEADING_TAGS[tag] + " ")
+        elif tag == "li":
+            self.output.append("\n- ")
+        elif tag in BLOCK_TAGS:
+            self.output.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag == "table" and self.tables:
+            table = self.tables.pop()
+            rows = [[("".join(text), row_span, column_span) for text, row_span, column_span in row] for row in table["rows"]]
+            if self.tables:
+                # a nested table is flattened into the enclosing cell
+                self.text(" ".join(text for row in rows for text, _, _ in row))
+            else:
+                self.output.append("\n" + table_markdown(expand_spans(rows)) + "\n")
+        elif self.tables:
+            if tag in ("td", "th"):
+                self.tables[-1]["cell"] = None
+        elif tag in HEADING_TAGS or tag in BLOCK_TAGS:
+            self.output.append("\n")
+
+    def handle_data(self, data):
+        if self.tables:
+            self.text(data)
+        else:
+            self.output.append(data)
+
+    def markdown(self):
+        self.close()
+        text = "".join(self.output)
+        return re.sub(r"\n{3,}", "\n\n", text).strip("\n")
+
+
+def html_to_markdown(html):
+    parser = TableHTMLParser()
+    parser.feed(html)
+    return parser.markdown()
+
+
+def split_markdown_row(line):
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|") and not line.endswith("\\|"):
+        line = line[:-1]
+    return [cell.replace("\\|", "|") for cell in UNESCAPED_PIPE.split(line)]
+
+
+def normalize_markdown_tables(text):
+    # rewrites every markdown table (a row, a separator row and more rows)
+    # in the canonical form; other lines are left as they are
+    lines = text.split("\n")
+    output = []
+    idx = 0
+    while idx < len(lines):
+        if (
+            lines[idx].lstrip().startswith("|") and idx + 1 < len(lines)
+            and SEPARATOR_ROW.match(lines[idx + 1].strip())
+        ):
+            rows = [split_markdown_row(lines[idx])]
+            idx += 2
+            while idx < len(lines) and lines[idx].lstrip().startswith("|"):
+                rows.append(split_markdown_row(lines[idx]))
+                idx += 1
+            output.append(table_markdown(rows))
+            continue
+        output.append(lines[idx])
+        idx += 1
+    return "\n".join(output)
+
+
+def normalize_tables(text):
+    # HTML tables become markdown tables, and every markdown table is
+    # rewritten canonically, so the same table costs the same tokens
+    # whichever parser produced it
+    if "<table" in text or "<TABLE" in text:
+        text = HTML_TABLE.sub(lambda match: "\n" + html_to_markdown(match.group(0)) + "\n", text)
+    if "|" in text:
+        text = normalize_markdown_tables(text)
+    return text
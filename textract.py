@@ -0,0 +1,152 @@
+import html
+
+
+def index_blocks(blocks):
+    return {block["Id"]: block for block in blocks}
+
+
+def child_ids(block, relationship_type="CHILD"):
+    for relationship in block.get("Relationships", ()):
+        if relationship["Type"] == relationship_type:
+            yield from relationship["Ids"]
+
+
+def bounding_box(block):
+    bbox = block["Geometry"]["BoundingBox"]
+
+    x = bbox["Left"]
+    y = bbox["Top"]
+    w = bbox["Width"]
+    h = bbox["Height"]
+
+    coord = [
+        [x, y],
+        [x + w, y],
+        [x + w, y + h],
+        [x, y + h]
+    ]
+    return [{"x": x, "y": y} for x, y in coord]
+
+
+def word_text(block, blocks_map):
+    return " ".join(
+        blocks_map[child_id]["Text"]
+        for child_id in child_ids(block)
+        if blocks_map[child_id]["BlockType"] == "WORD"
+    )
+
+
+def layout_text(block, blocks_map):
+    # every LINE the layout block points to, one per line
+    lines = []
+    for relationship in block.get("Relationships", ()):
+        for child_id in relationship["Ids"]:
+            child = blocks_map[child_id]
+            if child["BlockType"] == "LINE":
+                lines.append(child["Text"] + "\n")
+    return "".join(lines)
+
+
+def table_grid(table, blocks_map):
+    # (row, column) -> (row_span, column_span, text) for every cell that
+    # starts at that position, with merged cells replacing what they cover
+    cells = {}
+    for cell_id in child_ids(table):
+        cell = blocks_map.get(cell_id)
+        if cell is not None and cell["BlockType"] == "CELL":
+            cells[(cell["RowIndex"] - 1, cell["ColumnIndex"] - 1)] = (
+                cell["RowSpan"], cell["ColumnSpan"], word_text(cell, blocks_map)
+            )
+
+    if not cells:
+        return []
+
+    n_rows = max(row for row, _ in cells) + 1
+    n_columns = max(column for _, column in cells) + 1
+
+    for cell_id in child_ids(table, "MERGED_CELL"):
+        merged = blocks_map.get(cell_id)
+        if merged is None or merged["BlockType"] != "MERGED_CELL":
+            continue
+
+        row, column = merged["RowIndex"] - 1, merged["ColumnIndex"] - 1
+        row_span, column_span = merged["RowSpan"], merged["ColumnSpan"]
+        for i in range(row_span):
+            for j in range(column_span):
+                cells.pop((row + i, column + j), None)
+
+        text = " ".join(
+            word_text(blocks_map[child_id], blocks_map)
+            for child_id in merged["Relationships"][0]["Ids"]
+        )
+        cells[(row, column)] = (row_span, column_span, text)
+
+    grid = [[None] * n_columns for _ in range(n_rows)]
+    for (row, column), cell in cells.items():
+        if row < n_rows and column < n_columns:
+            grid[row][column] = cell
+    return grid
+
+
+def table_html(grid):
+    parts = ["<table>"]
+    for row in grid:
+        parts.append("<tr>")
+        for cell in row:
+            if cell is not None:
+                row_span, column_span, text = cell
+                parts.append(f"<td rowspan='{row_span}' colspan='{column_span}'>{html.escape(text, quote=False)}</td>")
+        parts.append("</tr>")
+    parts.append("</table>")
+    return "".join(parts)
+
+
+def post_process(data):
+    blocks = data["Blocks"]
+    blocks_map = index_blocks(blocks)
+
+    processed_list = []
+    for idx, elem in enumerate(blocks):
+        block_type = elem["BlockType"]
+        if block_type == "LAYOUT_LIST":
+            continue
+
+        if "LAYOUT" in block_type and block_type != "LAYOUT_TABLE":
+            transcription = ""
+            if block_type != "LAYOUT_FIGURE":
+                transcription = layout_text(elem, blocks_map)
+
+            processed_list.append({
+                "coordinates": bounding_box(elem),
+                "category": block_type,
+                "id": idx,
+                "content": {
+                    "text": transcription,
+                    "html": "",
+                    "markdown": ""
+                }
+            })
+
+        elif block_type == "TABLE":
+            processed_list.append({
+                "coordinates": bounding_box(elem),
+                "category": block_type,
+                "id": idx,
+                "content": {
+                    "text": "",
+                    "html": table_html(table_grid(elem, blocks_map)),
+                    "markdown": ""
+                }
+            })
+
+    return processed_list
+
+
+def to_text(processed_list, html_to_markdown):
+    texts = []
+    for elem in processed_list:
+        if elem["content"]["html"]:
+            texts.append(html_to_markdown(elem["content"]["html"]) + "\n")
+        else:
+            texts.append(elem["content"]["text"] + "\n")
+    return "".join(texts)
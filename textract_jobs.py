@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import asyncio
+import threading
+
+import timing
+from resilience import call_with_retry
+
+
+class NotificationError(Exception):
+    pass
+
+
+class SQSNotifier:
+    # completion-notification path: Textract publishes to SNS, which fans out
+    # to an SQS queue that is long-polled here instead of polling every job.
+    # After max_failures consecutive receive errors the notifier gives up and
+    # waiting jobs fall back to polling
+    def __init__(self, sqs, queue_url, topic_arn, role_arn, max_failures=5, max_backoff=60.0):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.notification_channel = {"SNSTopicArn": topic_arn, "RoleArn": role_arn}
+        self.max_failures = max_failures
+        self.max_backoff = max_backoff
+        self.waiters = {}
+        self.finished = {}
+        self.task = None
+        self.error = None
+
+    def register(self, job_id):
+        if self.error is not None:
+            raise NotificationError(str(self.error))
+        future = asyncio.get_running_loop().create_future()
+        if job_id in self.finished:
+            future.set_result(self.finished.pop(job_id))
+        else:
+            self.waiters[job_id] = future
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.listen())
+        return future
+
+    async def listen(self):
+        failures = 0
+        while True:
+            try:
+                response = await asyncio.to_thread(
+                    self.sqs.receive_message,
+                    QueueUrl=self.queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=20
+                )
+            except Exception as exc:
+                failures += 1
+                if failures >= self.max_failures:
+                    self.fail(exc)
+                    return
+                print("SQS receive failed ({}), retrying: {}".format(failures, exc))
+                await asyncio.sleep(min(self.max_backoff, 2 ** failures))
+                continue
+            failures = 0
+
+            for message in response.get("Messages", []):
+                try:
+                    body = json.loads(message["Body"])
+                    notification = json.loads(body.get("Message", message["Body"]))
+                    job_id, status = notification["JobId"], notification["Status"]
+                except (json.JSONDecodeError, KeyError, TypeError, AttributeError) as exc:
+                    print("Ignoring malformed Textract notification: {}".format(exc))
+                    job_id = None
+
+                if job_id is not None:
+                    future = self.waiters.pop(job_id, None)
+                    if future is None:
+                        self.finished[job_id] = status
+                    elif not future.done():
+                        future.set_result(status)
+
+                try:
+                    await asyncio.to_thread(
+                        self.sqs.delete_message,
+                        QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"]
+                    )
+                except Exception as exc:
+                    # the message comes back after its visibility timeout
+                    print("Could not delete SQS message: {}".format(exc))
+
+    def fail(self, exc):
+        print("SQS notifications failed, polling Textract instead: {}".format(exc))
+        self.error = exc
+        waiters, self.waiters = self.waiters, {}
+        for future in waiters.values():
+            if not future.done():
+                future.set_exception(NotificationError(str(exc)))
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def put_file(obj, path):
+    # opened per attempt, so a retried upload sends the whole file again
+    with open(path, "rb") as f:
+        obj.put(Body=f)
+
+
+class TextractJobRunner:
+    # runs asynchronous Textract jobs for multi-page documents on one event
+    # loop, so uploads, job starts, polling and result paging of many
+    # documents overlap; worker threads block on analyze() for their document
+    def __init__(
+        self, client, s3, bucket, feature_types,
+        min_poll=1.0, max_poll=20.0, backoff=1.5, notifier=None, policy=None
+    ):
+        self.client = client
+        self.s3 = s3
+        self.bucket = bucket
+        self.feature_types = feature_types
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.backoff = backoff
+        self.notifier = notifier
+        self.policy = policy
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def call(self, fn, **kwargs):
+        return asyncio.to_thread(call_with_retry, fn, policy=self.policy, **kwargs)
+
+    async def upload(self, path):
+        # same-named files from different directories, or identical files
+        # uploaded at once, never share an object: its job can only see its
+        # own document, and deleting it afterwards cannot affect another job
+        key = "{}-{}{}".format(
+            await asyncio.to_thread(file_digest, path), uuid.uuid4().hex[:8], os.path.splitext(path)[1]
+        )
+        await self.call(put_file, obj=self.s3.Object(self.bucket, key), path=path)
+        return key
+
+    async def delete(self, key):
+        try:
+            await self.call(self.s3.Object(self.bucket, key).delete)
+        except Exception as exc:
+            print("Could not delete s3://{}/{}: {}".format(self.bucket, key, exc))
+
+    async def start_job(self, key):
+        kwargs = {
+            "DocumentLocation": {"S3Object": {"Bucket": self.bucket, "Name": key}},
+            "FeatureTypes": self.feature_types,
+        }
+        if self.notifier is not None:
+            kwargs["NotificationChannel"] = self.notifier.notification_channel
+        response = await self.call(self.client.start_document_analysis, **kwargs)
+        return response["JobId"]
+
+    async def wait_for_job(self, job_id):
+        if self.notifier is not None:
+            try:
+                return await self.notifier.register(job_id)
+            except NotificationError:
+                pass
+
+        # poll often at first, then back off for long-running jobs
+        delay = self.min_poll
+        while True:
+            await asyncio.sleep(delay)
+            response = await self.call(self.client.get_document_analysis, JobId=job_id, MaxResults=1)
+            if response["JobStatus"] != "IN_PROGRESS":
+                return response["JobStatus"]
+            delay = min(delay * self.backoff, self.max_poll)
+
+    async def get_job_results(self, job_id):
+        pages = []
+        kwargs = {"JobId": job_id, "MaxResults": 1000}
+        while True:
+            response = await self.call(self.client.get_document_analysis, **kwargs)
+            pages.append(response)
+            if "NextToken" not in response:
+                return pages
+            kwargs["NextToken"] = response["NextToken"]
+
+    async def process(self, path, phases):
+        start = time.perf_counter()
+        key = await self.upload(path)
+        phases["upload"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            job_id = await self.start_job(key)
+            status = await self.wait_for_job(job_id)
+        finally:
+            await self.delete(key)
+        phases["provider_wait"] = time.perf_counter() - start
+        if status not in ("SUCCEEDED", "PARTIAL_SUCCESS"):
+            raise RuntimeError("Textract job {} for {} ended with status {}".format(job_id, path, status))
+
+        start = time.perf_counter()
+        pages = await self.get_job_results(job_id)
+        phases["download"] = time.perf_counter() - start
+        return {"Blocks": [block for page in pages for block in page.get("Blocks", [])]}
+
+    def analyze(self, path):
+        # the job runs on the runner's loop, so its phase timings are handed
+        # back and recorded in the calling worker's timing record
+        phases = {}
+        try:
+            return asyncio.run_coroutine_threadsafe(self.process(path, phases), self.loop).result()
+        finally:
+            for name, seconds in phases.items():
+                timing.add_phase(name, seconds)
+
+    def close(self):
+        if self.notifier is not None:
+            asyncio.run_coroutine_threadsafe(self.notifier.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
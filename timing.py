@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextlib
+import contextvars
+
+from utils import atomic_write
+
+_record = contextvars.ContextVar("timing_record", default=None)
+_labels = contextvars.ContextVar("timing_labels", default={})
+
+PERCENTILES = (50, 95, 99)
+
+
+class TimingLog:
+    # per-item timing records appended as JSON lines while the run goes on;
+    # a log without a path records nothing
+    def __init__(self, path=None):
+        self.path = path
+        self.run = uuid.uuid4().hex[:12]
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        if self.path is None:
+            return
+        record["run"] = self.run
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def records(self, run=None):
+        if self.path is None or not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if run is None or record.get("run") == run:
+                    records.append(record)
+        return records
+
+
+def open_timing_log(save_dir, rerun=False):
+    os.makedirs(save_dir, exist_ok=True)
+    path = os.path.join(save_dir, "timing.jsonl")
+    if rerun and os.path.exists(path):
+        os.remove(path)
+    return TimingLog(path)
+
+
+@contextlib.contextmanager
+def labels(**fields):
+    # fields copied into every record started inside the block
+    token = _labels.set({**_labels.get(), **fields})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+@contextlib.contextmanager
+def timed(log, **fields):
+    record = dict(_labels.get())
+    record.update(fields)
+    # time spent waiting for a worker slot, set by the engine
+    queue_wait = record.pop("queue_wait", None)
+    phases = {} if queue_wait is None else {"queue": queue_wait}
+    record.update({"start": time.time(), "status": "ok", "phases": phases})
+    token = _record.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as exc:
+        record["status"] = "error"
+        record["error"] = type(exc).__name__
+        raise
+    finally:
+        record["latency"] = time.perf_counter() - start
+        _record.reset(token)
+        if log is not None:
+            log.write(record)
+
+
+def add_phase(name, seconds):
+    record = _record.get()
+    if record is not None:
+        record["phases"][name] = record["phases"].get(name, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(name, time.perf_counter() - start)
+
+
+def add_count(name, value=1):
+    record = _record.get()
+    if record is not None and value is not None:
+        record[name] = record.get(name, 0) + value
+
+
+def set_status(status):
+    record = _record.get()
+    if record is not None:
+        record["status"] = status
+
+
+def add_usage(usage):
+    if usage is None:
+        return
+    add_count("prompt_tokens", getattr(usage, "prompt_tokens", None))
+    add_count("completion_tokens", getattr(usage, "completion_tokens", None))
+
+
+def percentile(values, q):
+    # linear interpolation between the closest ranks
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def distribution(values):
+    summary = {"mean": sum(values) / len(values) if values else None}
+    for q in PERCENTILES:
+        summary["p{}".format(q)] = percentile(values, q)
+    return summary
+
+
+def summarize(records, group_by=("kind", "provider", "model")):
+    # latency percentiles are over requests actually sent (status "ok");
+    # cached, skipped and failed items are only counted
+    groups = {}
+    for record in records:
+        key = tuple(record.get(field) for field in group_by)
+        groups.setdefault(key, []).append(record)
+
+    summary = []
+    for key, group in sorted(groups.items(), key=lambda item: [str(part) for part in item[0]]):
+        sent = [record for record in group if record["status"] == "ok"]
+        phases = {}
+        for record in sent:
+            for name, seconds in record["phases"].items():
+                phases.setdefault(name, []).append(seconds)
+
+        entry = {field: value for field, value in zip(group_by, key) if value is not None}
+        entry["count"] = len(group)
+        for status in ("ok", "cached", "skipped", "error"):
+            entry[status] = sum(1 for record in group if record["status"] == status)
+        entry["latency"] = distribution([record["latency"] for record in sent])
+        entry["phases"] = {name: distribution(values) for name, values in phases.items()}
+        for name in ("prompt_tokens", "completion_tokens", "retries"):
+            total = sum(record.get(name, 0) for record in group)
+            if total:
+                entry[name] = total
+        summary.append(entry)
+    return summary
+
+
+def format_summary(summary):
+    lines = []
+    for entry in summary:
+        name = " / ".join(str(entry[field]) for field in ("kind", "provider", "model") if field in entry)
+        counts = ", ".join(
+            "{} {}".format(entry[status], status)
+            for status in ("ok", "cached", "skipped", "error") if entry[status]
+        )
+        lines.append("{}: {}".format(name, counts))
+
+        rows = [("latency", entry["latency"])] + sorted(entry["phases"].items())
+        for label, values in rows:
+            if values["p50"] is None:
+                continue
+            lines.append("  {:<12} p50 {:8.3f}s  p95 {:8.3f}s  p99 {:8.3f}s".format(
+                label, values["p50"], values["p95"], values["p99"]
+            ))
+        tokens = [
+            "{} {}".format(entry[name], name)
+            for name in ("prompt_tokens", "completion_tokens", "retries") if name in entry
+        ]
+        if tokens:
+            lines.append("  " + ", ".join(tokens))
+    return "\n".join(lines)
+
+
+def write_parquet(records, path):
+    import pandas as pd
+
+    rows = []
+    for record in records:
+        row = {key: value for key, value in record.items() if key != "phases"}
+        for name, seconds in record["phases"].items():
+            row["phase_" + name] = seconds
+        rows.append(row)
+    pd.DataFrame(rows).to_parquet(path, index=False)
+
+
+def write_report(log, save_dir, parquet=False):
+    records = log.records(run=log.run)
+    summary = summarize(records)
+    atomic_write(os.path.join(save_dir, "timing_summary.json"), json.dumps(summary, indent=2))
+    if parquet:
+        write_parquet(records, os.path.join(save_dir, "timing.parquet"))
+    if summary:
+        print(format_summary(summary))
+    return summary
+
+
+def latest_run_records(save_dir):
+    # the records of the last run written to a directory's timing.jsonl
+    records = TimingLog(os.path.join(save_dir, "timing.jsonl")).records()
+    if not records:
+        return []
+    return [record for record in records if record.get("run") == records[-1].get("run")]
+
+
+def merge_reports(save_dir, shard_dirs, parquet=False):
+    # one report over the latest run of every shard
+    records = [record for shard_dir in shard_dirs for record in latest_run_records(shard_dir)]
+    summary = summarize(records)
+    atomic_write(os.path.join(save_dir, "timing_summary.json"), json.dumps(summary, indent=2))
+    if parquet:
+        write_parquet(records, os.path.join(save_dir, "timing.parquet"))
+    if summary:
+        print(format_summary(summary))
+    return summary
@@ -1,20 +1,119 @@
 import os
-from glob import glob
+import zlib
+import functools
+import mimetypes
+import tempfile
 
-# write a code that reads all the image files in a folder
-def get_image_path_list(path):
-    image_paths = glob(path + '/*')
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff', '.gif', '.pdf'}
+IMAGE_MIME_PREFIXES = ('image/', 'application/pdf')
 
-    return image_paths
+def iter_files(path, extensions=None, mime_prefixes=(), recursive=True):
+    # walks the directory tree with os.scandir and yields matching files as
+    # they are found, in sorted order within each directory so the order is
+    # the same on every run; hidden files and directories are skipped
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_dir():
+            if recursive:
+                yield from iter_files(entry.path, extensions, mime_prefixes, recursive)
+        elif entry.is_file() and (extensions is None or is_file_type(entry.name, extensions, mime_prefixes)):
+            yield entry.path
+
+def is_file_type(filename, extensions, mime_prefixes=()):
+    if os.path.splitext(filename)[1].lower() in extensions:
+        return True
+    # extensions not listed, e.g. '.jfif', are matched by MIME type
+    mime_type = mimetypes.guess_type(filename)[0]
+    return mime_type is not None and mime_type.startswith(tuple(mime_prefixes))
+
+def in_shard(item, shard):
+    # a stable hash of the item's relative path, so it stays in the same
+    # shard when other files are added or removed
+    index, count = shard
+    return zlib.crc32(item.encode('utf-8')) % count == index
+
+def parse_shard(text):
+    # '2/8' -> (2, 8), the third of eight shards
+    index, count = (int(part) for part in text.split('/'))
+    if not 0 <= index < count:
+        raise ValueError('shard index must be in [0, {})'.format(count))
+    return index, count
+
+def shard_dir(save_dir, shard):
+    return os.path.join(save_dir, 'shard-{}-of-{}'.format(*shard))
+
+def shard_path(path, shard):
+    # results/contents.jsonl -> results/contents.shard-2-of-8.jsonl
+    root, ext = os.path.splitext(path)
+    return '{}.shard-{}-of-{}{}'.format(root, shard[0], shard[1], ext)
+
+def iter_image_paths(path, recursive=True, shard=None):
+    for image_path in iter_files(path, IMAGE_EXTENSIONS, IMAGE_MIME_PREFIXES, recursive):
+        if shard is None or in_shard(os.path.relpath(image_path, path), shard):
+            yield image_path
+
+def get_image_path_list(path, recursive=True, shard=None):
+    return list(iter_image_paths(path, recursive, shard))
+
+def get_content_path_list(path, recursive=True, shard=None):
+    # extracted .txt contents, without the time.txt written by each run
+    return [
+        file_path for file_path in iter_files(path, {'.txt'}, recursive=recursive)
+        if os.path.basename(file_path) != 'time.txt'
+        and (shard is None or in_shard(os.path.relpath(file_path, path), shard))
+    ]
+
+def document_basename(path):
+    filename = os.path.basename(path)
+    return '.'.join(filename.split('.')[:-1])
+
+def duplicate_basenames(paths):
+    # basename -> paths for documents in different directories with the same
+    # name; they would share a question file, manifest entry and outputs
+    by_basename = {}
+    for path in paths:
+        by_basename.setdefault(document_basename(path), []).append(path)
+    return {basename: paths for basename, paths in by_basename.items() if len(paths) > 1}
+
+@functools.lru_cache(maxsize=None)
+def question_index(basepath):
+    # document basename -> question file, built once per directory; question
+    # files are named after their image, e.g. '<basename>.jpg.json'. A
+    # basename shared by several files maps to None
+    index = {}
+    for question_path in iter_files(basepath, {'.json'}):
+        basename = document_basename(question_path)
+        for key in {basename, document_basename(basename) or basename}:
+            index[key] = None if key in index and index[key] != question_path else question_path
+    return index
+
+def atomic_write(path, content):
+    # write to a temp file in the same directory and rename it into place,
+    # so an interrupted run never leaves a truncated file behind
+    dirname = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
 def save_txt(image_path, image_dir, save_dir, content):
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+    # images in subdirectories are saved to the same subdirectories
+    relative_dir = os.path.dirname(os.path.relpath(image_path, image_dir))
+    if not relative_dir.startswith('..'):
+        save_dir = os.path.join(save_dir, relative_dir)
+    os.makedirs(save_dir, exist_ok=True)
 
-    filename = os.path.basename(image_path)
-    basename = '.'.join(filename.split('.')[:-1])
+    save_path = os.path.join(save_dir, document_basename(image_path) + ".txt")
 
-    save_path = os.path.join(save_dir, basename + ".txt")
+    atomic_write(save_path, content)
 
-    with open(save_path, 'w') as f:
-        f.write(content)
+    return save_path